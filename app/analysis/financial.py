@@ -235,7 +235,9 @@ class FinancialAnalyzer:
             ValueError: Si los datos del proyecto son inválidos
         """
         try:
-            logger.info(f"Iniciando análisis para proyecto: {proyecto.dict()}")
+            # El volcado completo del proyecto solo se arma al depurar
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Iniciando análisis para proyecto: %s", proyecto.model_dump_json())
             
             # Obtener datos históricos del cultivo
             datos_historicos = await maga_api.get_datos_historicos(proyecto.cultivo)
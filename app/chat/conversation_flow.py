@@ -2,8 +2,10 @@
 Módulo para manejar el flujo de conversación con usuarios
 """
 from typing import Dict, Any, Optional, List
+import asyncio
 import logging
 import re
+import unicodedata
 import unidecode
 from datetime import datetime
 
@@ -16,6 +18,20 @@ from app.scoring.credit_score import score_calculator
 
 logger = logging.getLogger(__name__)
 
+# Mensajes que reinician la conversación, ya normalizados
+_RESTART_COMMANDS = frozenset({'reiniciar', 'reset', 'comenzar', 'inicio', 'hola'})
+
+# Respuestas afirmativas y negativas aceptadas en las preguntas de SI/NO.
+# Van sin tildes: se comparan con el texto ya normalizado por _normalize_text
+_YES_ANSWERS = frozenset({
+    'si', 's', 'yes', 'claro', 'por supuesto', 'ok', 'dale', 'va', 'bueno',
+    'esta bien', 'adelante', 'hagamoslo', 'me interesa'
+})
+_NO_ANSWERS = frozenset({'no', 'n', 'nel', 'nop', 'nope', 'nunca', 'jamas', 'negativo'})
+
+# Respuesta a mensajes sin texto (imágenes, audios, stickers)
+_TEXT_ONLY_MESSAGE = "❌ Por favor, envía solo mensajes de texto."
+
 class ConversationFlow:
     """Maneja el flujo de conversación con usuarios"""
     
@@ -54,6 +70,61 @@ class ConversationFlow:
         self.valid_irrigation = [
             'goteo', 'aspersion', 'gravedad', 'temporal'
         ]
+        
+        # Campo de user_data['data'] que llena la respuesta de cada estado
+        self._state_fields = {
+            self.STATES['GET_CROP']: 'crop',
+            self.STATES['GET_AREA']: 'area',
+            self.STATES['GET_CHANNEL']: 'channel',
+            self.STATES['GET_IRRIGATION']: 'irrigation',
+            self.STATES['GET_LOCATION']: 'location'
+        }
+        
+        # Estados que esperan una respuesta de SI/NO
+        self._yes_no_states = frozenset({
+            self.STATES['ASK_LOAN'],
+            self.STATES['CONFIRM_LOAN'],
+            self.STATES['SHOW_ANALYSIS'],
+            self.STATES['SHOW_LOAN']
+        })
+        
+        # Estados que envían su propio mensaje en lugar de la siguiente pregunta
+        self._states_without_prompt = frozenset({
+            self.STATES['SHOW_LOAN'],
+            self.STATES['CONFIRM_LOAN'],
+            self.STATES['DONE'],
+            self.STATES['SHOW_ANALYSIS']
+        })
+        
+        # Preguntas de cada estado. No dependen de los datos del usuario,
+        # así que se arman una sola vez
+        channels = [
+            "1. Mayorista",
+            "2. Cooperativa",
+            "3. Exportación",
+            "4. Mercado Local"
+        ]
+        irrigation = [
+            "1. Goteo",
+            "2. Aspersión",
+            "3. Gravedad",
+            "4. Ninguno (depende de lluvia)"
+        ]
+        self._next_messages = {
+            self.STATES['GET_AREA']: "¿Cuántas hectáreas planea sembrar? 🌱",
+            self.STATES['GET_CHANNEL']: (
+                "¿Cómo planeas comercializar tu producto? 🏪\n\n" +
+                "\n".join(channels) +
+                "\n\nResponde con el número de tu elección"
+            ),
+            self.STATES['GET_IRRIGATION']: (
+                "¿Qué sistema de riego utilizarás? 💧\n\n" +
+                "\n".join(irrigation) +
+                "\n\nResponde con el número de tu elección"
+            ),
+            self.STATES['GET_LOCATION']: "¿En qué departamento está ubicado el terreno? 📍",
+            self.STATES['SHOW_ANALYSIS']: ""  # No mostrar mensaje adicional
+        }
     
     def _normalize_text(self, text: str) -> str:
         """
@@ -62,7 +133,6 @@ class ConversationFlow:
         - Convierte a minúsculas
         - Remueve espacios extra
         """
-        import unicodedata
         if not text:
             return ""
             
@@ -126,42 +196,7 @@ class ConversationFlow:
         Returns:
             str: Mensaje para el usuario
         """
-        if current_state == self.STATES['GET_AREA']:
-            return "¿Cuántas hectáreas planea sembrar? 🌱"
-            
-        elif current_state == self.STATES['GET_CHANNEL']:
-            channels = [
-                "1. Mayorista",
-                "2. Cooperativa",
-                "3. Exportación",
-                "4. Mercado Local"
-            ]
-            return (
-                "¿Cómo planeas comercializar tu producto? 🏪\n\n" +
-                "\n".join(channels) +
-                "\n\nResponde con el número de tu elección"
-            )
-            
-        elif current_state == self.STATES['GET_IRRIGATION']:
-            irrigation = [
-                "1. Goteo",
-                "2. Aspersión",
-                "3. Gravedad",
-                "4. Ninguno (depende de lluvia)"
-            ]
-            return (
-                "¿Qué sistema de riego utilizarás? 💧\n\n" +
-                "\n".join(irrigation) +
-                "\n\nResponde con el número de tu elección"
-            )
-            
-        elif current_state == self.STATES['GET_LOCATION']:
-            return "¿En qué departamento está ubicado el terreno? 📍"
-            
-        elif current_state == self.STATES['SHOW_ANALYSIS']:
-            return ""  # No mostrar mensaje adicional
-            
-        return "❌ Estado no válido"
+        return self._next_messages.get(current_state, "❌ Estado no válido")
 
     def validate_input(self, current_state: str, user_input: str) -> tuple:
         """
@@ -216,17 +251,12 @@ class ConversationFlow:
                 return True, user_input.strip().capitalize()
             return False, None
             
-        elif current_state in [self.STATES['ASK_LOAN'], self.STATES['CONFIRM_LOAN'], self.STATES['SHOW_ANALYSIS'], self.STATES['SHOW_LOAN']]:
-            # Validar respuestas SI/NO
-            respuestas_si = ['si', 'sí', 's', 'yes', 'claro', 'por supuesto', 'ok', 'dale', 'va', 'bueno', 
-                'esta bien', 'está bien', 'adelante', 'hagamoslo', 'hagámoslo', 'me interesa']
-            respuestas_no = ['no', 'n', 'nel', 'nop', 'nope', 'nunca', 'jamas', 'jamás', 'negativo']
-            
-            normalized_input = unidecode(user_input.lower().strip())
-            
-            if normalized_input in respuestas_si:
+        elif current_state in self._yes_no_states:
+            # Validar respuestas SI/NO. user_input ya viene sin tildes y en
+            # minúsculas de _normalize_text
+            if user_input in _YES_ANSWERS:
                 return True, True
-            elif normalized_input in respuestas_no:
+            elif user_input in _NO_ANSWERS:
                 return True, False
             else:
                 return False, None
@@ -327,6 +357,23 @@ class ConversationFlow:
         # Si no hay coincidencia, devolver el cultivo original con la primera letra en mayúscula
         return crop.capitalize()
     
+    async def _start_over(self, phone_number: str) -> None:
+        """
+        Deja al usuario en la pregunta del cultivo y envía la bienvenida
+        
+        Args:
+            phone_number: Número de teléfono del usuario
+        """
+        user_data = {
+            'state': self.STATES['GET_CROP'],
+            'data': {}
+        }
+        # Guardar el estado y enviar la bienvenida no dependen uno del otro
+        await asyncio.gather(
+            firebase_manager.update_user_state(phone_number, user_data),
+            self.whatsapp.send_message(phone_number, self.get_welcome_message())
+        )
+    
     async def handle_message(self, phone_number: str, message: str):
         """
         Procesa un mensaje entrante de WhatsApp
@@ -339,25 +386,24 @@ class ConversationFlow:
             # Normalizar mensaje
             message = message.lower().strip()
             
+            # Los mensajes sin texto no pueden avanzar el flujo; se responden
+            # sin leer el estado del usuario
+            if not message:
+                await self.whatsapp.send_message(phone_number, _TEXT_ONLY_MESSAGE)
+                return
+            
             # Comando de reinicio o saludo inicial
-            if message in ['reiniciar', 'reset', 'comenzar', 'inicio', 'hola']:
+            if message in _RESTART_COMMANDS:
                 # Limpiar caché de Firebase
                 await firebase_manager.clear_user_cache(phone_number)
-                
-                user_data = {
-                    'state': self.STATES['GET_CROP'],
-                    'data': {}
-                }
-                await firebase_manager.update_user_state(phone_number, user_data)
-                welcome_message = self.get_welcome_message()
-                await self.whatsapp.send_message(phone_number, welcome_message)
+                await self._start_over(phone_number)
                 return
                 
             # Obtener o crear datos del usuario
             try:
                 user_data = await firebase_manager.get_conversation_state(phone_number)
             except Exception as e:
-                logger.error(f"Error obteniendo datos del usuario: {str(e)}")
+                logger.error("Error obteniendo datos del usuario: %s", e)
                 error_message = (
                     "Lo siento, ha ocurrido un error. Por favor intenta nuevamente "
                     "o contacta a soporte si el problema persiste."
@@ -367,27 +413,15 @@ class ConversationFlow:
                 
             if not user_data:
                 # Nuevo usuario, iniciar conversación
-                user_data = {
-                    'state': self.STATES['GET_CROP'],
-                    'data': {}
-                }
-                await firebase_manager.update_user_state(phone_number, user_data)
-                welcome_message = self.get_welcome_message()
-                await self.whatsapp.send_message(phone_number, welcome_message)
+                await self._start_over(phone_number)
                 return
                 
             current_state = user_data['state']
-            logger.info(f"Estado actual: {current_state}, Mensaje: {message}")
+            logger.debug("Estado actual: %s, Mensaje: %s", current_state, message)
             
             # Si conversación terminada, reiniciar
             if current_state == self.STATES['DONE']:
-                user_data = {
-                    'state': self.STATES['GET_CROP'],
-                    'data': {}
-                }
-                await firebase_manager.update_user_state(phone_number, user_data)
-                welcome_message = self.get_welcome_message()
-                await self.whatsapp.send_message(phone_number, welcome_message)
+                await self._start_over(phone_number)
                 return
             
             # Si está en estado inicial, cambiar a GET_CROP para aceptar el cultivo
@@ -400,7 +434,7 @@ class ConversationFlow:
             
             # Validar entrada del usuario
             is_valid, processed_value = self.validate_input(current_state, message)
-            logger.info(f"Validación: válido={is_valid}, valor={processed_value}")
+            logger.debug("Validación: válido=%s, valor=%s", is_valid, processed_value)
             
             if not is_valid:
                 # Enviar mensaje de error
@@ -409,16 +443,9 @@ class ConversationFlow:
                 return
                 
             # Actualizar datos del usuario
-            if current_state == self.STATES['GET_CROP']:
-                user_data['data']['crop'] = processed_value
-            elif current_state == self.STATES['GET_AREA']:
-                user_data['data']['area'] = processed_value
-            elif current_state == self.STATES['GET_CHANNEL']:
-                user_data['data']['channel'] = processed_value
-            elif current_state == self.STATES['GET_IRRIGATION']:
-                user_data['data']['irrigation'] = processed_value
-            elif current_state == self.STATES['GET_LOCATION']:
-                user_data['data']['location'] = processed_value
+            field = self._state_fields.get(current_state)
+            if field:
+                user_data['data'][field] = processed_value
                 
             # Obtener siguiente estado
             next_state = self.get_next_state(current_state, message, processed_value)
@@ -435,7 +462,7 @@ class ConversationFlow:
                     await firebase_manager.update_user_state(phone_number, user_data)
                     
                 except Exception as e:
-                    logger.error(f"Error procesando reporte: {str(e)}")
+                    logger.error("Error procesando reporte: %s", e)
                     # Mantener el estado actual si hay error
                     error_message = (
                         "Lo siento, ha ocurrido un error generando su reporte. "
@@ -453,7 +480,7 @@ class ConversationFlow:
                     await firebase_manager.update_user_state(phone_number, user_data)
                     return
                 except Exception as e:
-                    logger.error(f"Error confirmando préstamo: {str(e)}")
+                    logger.error("Error confirmando préstamo: %s", e)
                     error_message = (
                         "Lo siento, ha ocurrido un error procesando su solicitud. "
                         "Por favor intente de nuevo."
@@ -469,13 +496,13 @@ class ConversationFlow:
                     loan_offer = self.process_show_loan(user_data['data'])
                     await self.whatsapp.send_message(phone_number, loan_offer)
                 except ValueError as e:
-                    logger.error(f"Error mostrando préstamo: {str(e)}")
+                    logger.error("Error mostrando préstamo: %s", e)
                     error_message = str(e)
                     await self.whatsapp.send_message(phone_number, error_message)
                     # Regresar a ASK_LOAN
                     user_data['state'] = self.STATES['ASK_LOAN']
                 except Exception as e:
-                    logger.error(f"Error inesperado en préstamo: {str(e)}")
+                    logger.error("Error inesperado en préstamo: %s", e)
                     error_message = (
                         "Lo siento, ha ocurrido un error procesando su solicitud. "
                         "Por favor intente de nuevo."
@@ -489,7 +516,7 @@ class ConversationFlow:
                     confirm_message = self.process_confirm_loan(user_data)
                     await self.whatsapp.send_message(phone_number, confirm_message)
                 except Exception as e:
-                    logger.error(f"Error confirmando préstamo: {str(e)}")
+                    logger.error("Error confirmando préstamo: %s", e)
                     error_message = (
                         "Lo siento, ha ocurrido un error procesando su solicitud. "
                         "Por favor intente de nuevo."
@@ -510,15 +537,19 @@ class ConversationFlow:
                     )
             
             # Guardar estado actualizado
-            await firebase_manager.update_user_state(phone_number, user_data)
+            pending = [firebase_manager.update_user_state(phone_number, user_data)]
             
             # Si no es estado especial, mostrar siguiente mensaje
-            if next_state not in [self.STATES['SHOW_LOAN'], self.STATES['CONFIRM_LOAN'], self.STATES['DONE'], self.STATES['SHOW_ANALYSIS']]:
+            if next_state not in self._states_without_prompt:
                 next_message = self.get_next_message(next_state, user_data)
-                await self.whatsapp.send_message(phone_number, next_message)
+                pending.append(self.whatsapp.send_message(phone_number, next_message))
+            
+            # El guardado y el envío no dependen uno del otro; se esperan
+            # juntos para pagar un solo viaje de red por mensaje
+            await asyncio.gather(*pending)
             
         except Exception as e:
-            logger.error(f"Error procesando mensaje: {str(e)}")
+            logger.error("Error procesando mensaje: %s", e)
             error_message = (
                 "Lo siento, ha ocurrido un error. Por favor intenta nuevamente "
                 "o contacta a soporte si el problema persiste."
@@ -561,7 +592,7 @@ class ConversationFlow:
             return None
             
         except Exception as e:
-            logger.error(f"Error procesando estado {state}: {str(e)}")
+            logger.error("Error procesando estado %s: %s", state, e)
             return None
             
     def process_loan_question(self, message: str) -> str:
@@ -627,7 +658,7 @@ class ConversationFlow:
             return financial_presenter.format_financial_analysis(user_data)
             
         except Exception as e:
-            logger.error(f"Error analizando financiamiento: {str(e)}")
+            logger.error("Error analizando financiamiento: %s", e)
             raise ValueError(
                 "Lo sentimos, ha ocurrido un error analizando su proyecto. "
                 "Por favor intente nuevamente."
@@ -697,7 +728,7 @@ class ConversationFlow:
             return mensaje
             
         except Exception as e:
-            logger.error(f"Error calculando préstamo y Fingro Score: {str(e)}")
+            logger.error("Error calculando préstamo y Fingro Score: %s", e)
             return (
                 "Disculpe, hubo un problema al calcular su préstamo 😔\n"
                 "¿Le gustaría intentar de nuevo? 🔄"
@@ -768,7 +799,7 @@ class ConversationFlow:
             return self.process_financial_analysis(user_data)
             
         except Exception as e:
-            logger.error(f"Error procesando ubicación: {str(e)}")
+            logger.error("Error procesando ubicación: %s", e)
             return "Hubo un error. Por favor intente de nuevo 🙏"
 
     def process_financial_analysis(self, user_data: Dict[str, Any]) -> str:
@@ -793,7 +824,7 @@ class ConversationFlow:
             return self.format_financial_analysis(financial, user_data)
             
         except Exception as e:
-            logger.error(f"Error procesando análisis financiero: {str(e)}")
+            logger.error("Error procesando análisis financiero: %s", e)
             return (
                 "Disculpe, hubo un problema al generar su análisis 😔\n"
                 "¿Le gustaría intentar de nuevo? 🔄"
@@ -905,7 +936,7 @@ class ConversationFlow:
             return self.ask_channel(user_data)
             
         except Exception as e:
-            logger.error(f"Error procesando área: {str(e)}")
+            logger.error("Error procesando área: %s", e)
             return "Hubo un error. Por favor intente de nuevo con el área que está sembrando 🌱"
 
     def process_channel(self, user_data: Dict[str, Any], response: str) -> str:
@@ -948,7 +979,7 @@ class ConversationFlow:
             return self.ask_irrigation(user_data)
             
         except Exception as e:
-            logger.error(f"Error procesando canal: {str(e)}")
+            logger.error("Error procesando canal: %s", e)
             return "Hubo un error. Por favor intente de nuevo 🙏"
 
     def process_irrigation(self, user_data: Dict[str, Any], response: str) -> str:
@@ -991,7 +1022,7 @@ class ConversationFlow:
             return self.ask_location(user_data)
             
         except Exception as e:
-            logger.error(f"Error procesando sistema de riego: {str(e)}")
+            logger.error("Error procesando sistema de riego: %s", e)
             return "Hubo un error. Por favor intente de nuevo 🙏"
 
     def ask_location(self, user_data: Dict[str, Any]) -> str:
@@ -1075,7 +1106,7 @@ class ConversationFlow:
         Returns:
             str: Mensaje de error amigable
         """
-        logger.error(f"Error en {context}: {str(error)}")
+        logger.error("Error en %s: %s", context, error)
         
         # Mensajes por contexto
         mensajes = {
@@ -1290,7 +1321,7 @@ class ConversationFlow:
             return message
             
         except Exception as e:
-            logger.error(f"Error analizando financiamiento: {str(e)}")
+            logger.error("Error analizando financiamiento: %s", e)
             return "Lo sentimos, ha ocurrido un error analizando su proyecto. Por favor intente nuevamente."
 
     def validate_yes_no(self, response: str) -> bool:
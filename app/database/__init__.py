@@ -1,6 +1,6 @@
 """
 Inicialización del módulo de base de datos
 """
-from .firebase import firebase_manager
+from .firebase import firebase_manager, SERVER_TIMESTAMP
 
-__all__ = ['firebase_manager']
+__all__ = ['firebase_manager', 'SERVER_TIMESTAMP']
@@ -13,6 +13,39 @@ class FirebaseError(Exception):
     """Excepción personalizada para errores de Firebase"""
     pass
 
+# Máximo de operaciones por lote de escritura, igual que en Firestore
+BATCH_WRITE_LIMIT = 500
+
+class _ServerTimestamp:
+    """Centinela para que la base de datos asigne la hora de escritura"""
+    
+    def __repr__(self) -> str:
+        return "SERVER_TIMESTAMP"
+
+# Equivalente a firestore.SERVER_TIMESTAMP: el valor se resuelve al escribir
+SERVER_TIMESTAMP = _ServerTimestamp()
+
+def _apply_update(doc: Dict[str, Any], data: Dict[str, Any]) -> None:
+    """
+    Aplica una actualización interpretando las claves con punto como rutas
+    de campos anidados (p.ej. 'context.state'), igual que update() en Firestore
+    """
+    for field, value in data.items():
+        *parents, leaf = field.split('.')
+        target = doc
+        for parent in parents:
+            child = target.get(parent)
+            if not isinstance(child, dict):
+                child = target[parent] = {}
+            target = child
+        target[leaf] = value
+
+def _resolve_timestamps(data: Dict[str, Any], now: datetime) -> None:
+    """Reemplaza los centinelas SERVER_TIMESTAMP por la hora de escritura"""
+    for field, value in data.items():
+        if value is SERVER_TIMESTAMP:
+            data[field] = now
+
 class FirebaseDB:
     """Maneja la interacción con Firebase y el caché local"""
     
@@ -84,7 +117,7 @@ class FirebaseDB:
             
             return current_state
         except Exception as e:
-            logger.error(f"Error actualizando estado: {str(e)}")
+            logger.error("Error actualizando estado: %s", e)
             raise FirebaseError(f"Error updating conversation state: {str(e)}")
     
     async def get_document(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
@@ -98,6 +131,10 @@ class FirebaseDB:
         Returns:
             Optional[Dict[str, Any]]: Documento o None si no existe
         """
+        return self._read_document(collection, doc_id)
+    
+    def _read_document(self, collection: str, doc_id: str) -> Optional[Dict[str, Any]]:
+        """Lee un documento desde el caché o el almacenamiento en memoria"""
         cache_key = f"{collection}_{doc_id}"
         if cache_key in self.cache:
             return self.cache[cache_key]
@@ -110,6 +147,19 @@ class FirebaseDB:
         
         return doc
     
+    async def get_documents(self, refs: list[tuple[str, str]]) -> list[Optional[Dict[str, Any]]]:
+        """
+        Obtiene varios documentos en una sola lectura (equivalente a get_all)
+        
+        Args:
+            refs: Tuplas (colección, ID del documento)
+        
+        Returns:
+            list[Optional[Dict[str, Any]]]: Documentos en el mismo orden que refs,
+                con None para los que no existen
+        """
+        return [self._read_document(collection, doc_id) for collection, doc_id in refs]
+    
     async def add_document(self, collection: str, data: Dict[str, Any], doc_id: Optional[str] = None) -> str:
         """
         Agrega un documento a la colección
@@ -127,8 +177,10 @@ class FirebaseDB:
                 import uuid
                 doc_id = str(uuid.uuid4())
             
-            data["created_at"] = datetime.now().isoformat()
-            data["updated_at"] = data["created_at"]
+            now = datetime.now()
+            _resolve_timestamps(data, now)
+            data["created_at"] = now
+            data["updated_at"] = now
             
             collection_key = f"{collection}_{doc_id}"
             self.memory_db[collection_key] = data
@@ -139,7 +191,7 @@ class FirebaseDB:
             
             return doc_id
         except Exception as e:
-            logger.error(f"Error agregando documento: {str(e)}")
+            logger.error("Error agregando documento: %s", e)
             raise FirebaseError(f"Error adding document: {str(e)}")
     
     async def update_document(self, collection: str, doc_id: str, data: Dict[str, Any]) -> bool:
@@ -149,7 +201,7 @@ class FirebaseDB:
         Args:
             collection: Nombre de la colección
             doc_id: ID del documento
-            data: Datos a actualizar
+            data: Datos a actualizar; las claves con punto actualizan campos anidados
             
         Returns:
             bool: True si se actualizó correctamente
@@ -162,8 +214,10 @@ class FirebaseDB:
                 return False
             
             # Actualizar documento
-            data["updated_at"] = datetime.now().isoformat()
-            current_doc.update(data)
+            now = datetime.now()
+            _resolve_timestamps(data, now)
+            data["updated_at"] = now
+            _apply_update(current_doc, data)
             
             # Guardar en memoria
             self.memory_db[collection_key] = current_doc
@@ -174,10 +228,86 @@ class FirebaseDB:
             
             return True
         except Exception as e:
-            logger.error(f"Error actualizando documento: {str(e)}")
+            logger.error("Error actualizando documento: %s", e)
             raise FirebaseError(f"Error updating document: {str(e)}")
     
-    async def query_collection(self, collection: str, field: str, operator: str, value: Any) -> list[Dict[str, Any]]:
+    async def batch_set(self, writes: list[tuple[str, str, Dict[str, Any]]]) -> None:
+        """
+        Escribe varios documentos en un solo lote atómico
+        
+        Cada escritura crea el documento si no existe. Si existe, cada campo
+        de primer nivel reemplaza al guardado y los demás se conservan; los
+        mapas anidados no se combinan campo por campo, a diferencia de
+        set(..., merge=True) en Firestore.
+        
+        Args:
+            writes: Tuplas (colección, ID del documento, datos), máximo BATCH_WRITE_LIMIT
+        """
+        if len(writes) > BATCH_WRITE_LIMIT:
+            raise FirebaseError(f"Batch exceeds {BATCH_WRITE_LIMIT} writes")
+        
+        try:
+            now = datetime.now()
+            for collection, doc_id, data in writes:
+                data = dict(data)
+                _resolve_timestamps(data, now)
+                data["updated_at"] = now
+                
+                collection_key = f"{collection}_{doc_id}"
+                current_doc = self.memory_db.get(collection_key)
+                if current_doc is None:
+                    current_doc = {"created_at": now}
+                current_doc.update(data)
+                
+                self.memory_db[collection_key] = current_doc
+                self.cache[collection_key] = current_doc
+        except Exception as e:
+            logger.error("Error escribiendo lote: %s", e)
+            raise FirebaseError(f"Error writing batch: {str(e)}")
+    
+    async def get_collection(
+        self,
+        collection: str,
+        order_by: Optional[str] = None,
+        descending: bool = False,
+        limit: Optional[int] = None
+    ) -> list[Dict[str, Any]]:
+        """
+        Obtiene los documentos de una colección o subcolección
+        
+        Args:
+            collection: Ruta de la colección (p.ej. 'conversations/{id}/messages')
+            order_by: Campo opcional para ordenar los documentos
+            descending: Si el orden es descendente
+            limit: Cantidad máxima de documentos a devolver
+            
+        Returns:
+            list[Dict[str, Any]]: Documentos de la colección
+        """
+        try:
+            prefix = f"{collection}_"
+            result = [doc for key, doc in self.memory_db.items() if key.startswith(prefix)]
+            
+            if order_by:
+                result = [doc for doc in result if order_by in doc]
+                result.sort(key=lambda doc: doc[order_by], reverse=descending)
+            
+            if limit is not None:
+                result = result[:limit]
+            
+            return result
+        except Exception as e:
+            logger.error("Error obteniendo colección: %s", e)
+            raise FirebaseError(f"Error getting collection: {str(e)}")
+    
+    async def query_collection(
+        self,
+        collection: str,
+        field: str,
+        operator: str,
+        value: Any,
+        select: Optional[list[str]] = None
+    ) -> list[Dict[str, Any]]:
         """
         Consulta documentos en una colección
         
@@ -186,6 +316,7 @@ class FirebaseDB:
             field: Campo a comparar
             operator: Operador de comparación (==, >, <, >=, <=, !=)
             value: Valor a comparar
+            select: Campos a devolver; por defecto el documento completo
             
         Returns:
             list[Dict[str, Any]]: Lista de documentos que cumplen con la condición
@@ -215,9 +346,12 @@ class FirebaseDB:
                         if field in doc and doc[field] != value:
                             result.append(doc)
             
+            if select is not None:
+                result = [{f: doc[f] for f in select if f in doc} for doc in result]
+            
             return result
         except Exception as e:
-            logger.error(f"Error consultando colección: {str(e)}")
+            logger.error("Error consultando colección: %s", e)
             raise FirebaseError(f"Error querying collection: {str(e)}")
     
     async def update_user_state(self, phone: str, user_data: Dict[str, Any]) -> None:
@@ -235,7 +369,7 @@ class FirebaseDB:
             cache_key = f"user_{phone}"
             self.cache[cache_key] = user_data
         except Exception as e:
-            logger.error(f"Error al actualizar estado del usuario {phone}: {e}")
+            logger.error("Error al actualizar estado del usuario %s: %s", phone, e)
             raise FirebaseError(f"Error al actualizar usuario: {e}")
     
     async def clear_user_cache(self, phone: str) -> None:
@@ -262,9 +396,9 @@ class FirebaseDB:
             if conv_collection_key in self.memory_db:
                 del self.memory_db[conv_collection_key]
                 
-            logger.info(f"Caché del usuario {phone} limpiada correctamente")
+            logger.info("Caché del usuario %s limpiada correctamente", phone)
         except Exception as e:
-            logger.error(f"Error al limpiar caché del usuario {phone}: {e}")
+            logger.error("Error al limpiar caché del usuario %s: %s", phone, e)
             # No lanzamos excepción para no interrumpir el flujo si hay error de caché
 
 # Instancia global
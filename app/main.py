@@ -1,18 +1,22 @@
 """
 FastAPI app principal
 """
-from fastapi import FastAPI, Request, Response, HTTPException, Depends
+from fastapi import FastAPI, Request, Response, HTTPException, Depends, BackgroundTasks
 from fastapi.responses import JSONResponse
 from typing import Optional, Dict, Any, List
-import json
+import asyncio
 import logging
 import os
 import hmac
 import hashlib
+import queue
+import orjson
 from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from cachetools import TTLCache
 
 from app.config import settings
-from app.services.whatsapp_service import WhatsAppService
+from app.services.whatsapp_service import WhatsAppService, close_client
 from app.chat.conversation_flow import conversation_flow
 from app.database.firebase import firebase_manager
 
@@ -22,8 +26,21 @@ logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 
+# Mientras la aplicación corre, los registros pasan por una cola y los
+# handlers de la raíz los escriben desde el hilo del listener, así el event
+# loop no se bloquea en la salida
+_log_queue = queue.SimpleQueue()
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+log_listener: Optional[QueueListener] = None
+
+# httpx registra cada request en INFO, una línea por mensaje enviado; solo
+# se conserva al depurar
+if settings.LOG_LEVEL != "DEBUG":
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
 logger = logging.getLogger(__name__)
-logger.info(f"Iniciando FinGro Bot en modo: {settings.ENV}")
+logger.info("Iniciando FinGro Bot en modo: %s", settings.ENV)
 
 # Crear la app FastAPI
 app = FastAPI(
@@ -35,13 +52,45 @@ app = FastAPI(
 # Instanciar servicios
 whatsapp = WhatsAppService()
 
+@app.on_event("startup")
+async def startup():
+    """Pasa los handlers de logging de la raíz detrás de la cola"""
+    global log_listener
+    root = logging.getLogger()
+    log_listener = QueueListener(_log_queue, *root.handlers, respect_handler_level=True)
+    for handler in log_listener.handlers:
+        root.removeHandler(handler)
+    root.addHandler(_queue_handler)
+    log_listener.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Cierra el cliente de WhatsApp y vacía la cola de logging al detener la aplicación"""
+    global log_listener
+    await close_client()
+    if log_listener is not None:
+        root = logging.getLogger()
+        root.removeHandler(_queue_handler)
+        log_listener.stop()
+        for handler in log_listener.handlers:
+            root.addHandler(handler)
+        log_listener = None
+
+# HMAC ya preparado con el secreto del webhook; cada verificación parte de
+# una copia en lugar de volver a codificar y aplicar la clave
+_webhook_secret = getattr(settings, 'WHATSAPP_WEBHOOK_SECRET', None)
+_signature_hmac = (
+    hmac.new(_webhook_secret.encode(), digestmod=hashlib.sha256)
+    if _webhook_secret else None
+)
+
 async def verify_webhook_signature(request: Request) -> bool:
     """
     Verifica la firma del webhook de WhatsApp
     """
     try:
         # Si no hay secreto configurado, omitir la verificación
-        if not hasattr(settings, 'WHATSAPP_WEBHOOK_SECRET') or not settings.WHATSAPP_WEBHOOK_SECRET:
+        if _signature_hmac is None:
             logger.warning("WHATSAPP_WEBHOOK_SECRET no está configurado. Omitiendo verificación de firma")
             return True
             
@@ -54,22 +103,51 @@ async def verify_webhook_signature(request: Request) -> bool:
         body = await request.body()
         
         # Calcular firma esperada
-        expected_signature = hmac.new(
-            settings.WHATSAPP_WEBHOOK_SECRET.encode(),
-            body,
-            hashlib.sha256
-        ).hexdigest()
+        mac = _signature_hmac.copy()
+        mac.update(body)
+        expected_signature = mac.hexdigest()
         
         # Comparar firmas
         actual_signature = signature.replace('sha256=', '')
         return hmac.compare_digest(actual_signature, expected_signature)
         
     except Exception as e:
-        logger.error(f"Error verificando firma: {str(e)}")
+        logger.error("Error verificando firma: %s", e)
         return False
 
+# IDs de mensajes ya recibidos. WhatsApp reenvía el webhook cuando no
+# recibe respuesta a tiempo; un mensaje repetido no se vuelve a procesar
+_seen_messages: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+
+# Remitentes que se procesan a la vez en segundo plano. Limita el trabajo
+# pendiente si llega una ráfaga de webhooks
+MAX_CONCURRENT_SENDERS = 200
+_sender_slots = asyncio.Semaphore(MAX_CONCURRENT_SENDERS)
+
+async def _handle_sender(from_number: str, texts: List[str]) -> None:
+    """Procesa en orden los mensajes de un mismo remitente"""
+    async with _sender_slots:
+        for text in texts:
+            await conversation_flow.handle_message(from_number, text)
+
+async def _process_senders(by_sender: Dict[str, List[str]]) -> None:
+    """
+    Atiende los remitentes de un webhook en paralelo y los mensajes de cada
+    uno en orden
+    
+    Args:
+        by_sender: Textos recibidos agrupados por número, en orden de llegada
+    """
+    results = await asyncio.gather(
+        *(_handle_sender(number, texts) for number, texts in by_sender.items()),
+        return_exceptions=True
+    )
+    for number, result in zip(by_sender, results):
+        if isinstance(result, Exception):
+            logger.error("Error procesando mensajes de %s: %s", number, result)
+
 @app.post("/webhook/whatsapp")
-async def webhook(request: Request):
+async def webhook(request: Request, background_tasks: BackgroundTasks):
     """Endpoint para recibir webhooks de WhatsApp"""
     try:
         # En modo debug, no verificar firma
@@ -79,30 +157,50 @@ async def webhook(request: Request):
                 logger.warning("Firma inválida en webhook")
                 return JSONResponse(status_code=401, content={"error": "Firma inválida"})
             
-        # Procesar webhook
-        body = await request.json()
+        # Procesar webhook. El cuerpo ya se leyó para verificar la firma;
+        # orjson lo decodifica directamente desde los bytes
+        raw = await request.body()
+        
+        # La mayoría de los webhooks son solo estados de entrega; sin la
+        # clave "messages" no hay nada que procesar ni que decodificar
+        if b'"messages"' not in raw:
+            return {"status": "ok"}
+        body = orjson.loads(raw)
         
         # Validar estructura del webhook
         if 'entry' not in body or not body['entry']:
             logger.warning("Webhook sin entradas")
             return JSONResponse(status_code=400, content={"error": "Webhook inválido"})
             
-        # Procesar cada mensaje
+        # Agrupar los mensajes por remitente, conservando el orden de llegada
+        by_sender: Dict[str, List[str]] = {}
         for entry in body['entry']:
             for change in entry.get('changes', []):
-                if change.get('value', {}).get('messages'):
-                    for message in change['value']['messages']:
+                messages = change.get('value', {}).get('messages')
+                if messages:
+                    for message in messages:
+                        message_id = message.get('id')
+                        if message_id:
+                            if message_id in _seen_messages:
+                                continue
+                            _seen_messages[message_id] = True
+                        
                         # Obtener número y mensaje
                         from_number = message['from']
                         text = message.get('text', {}).get('body', '')
-                        
-                        # Procesar mensaje
-                        await conversation_flow.handle_message(from_number, text)
+                        by_sender.setdefault(from_number, []).append(text)
+        
+        if not by_sender:
+            return {"status": "ok"}
+        
+        # WhatsApp reintenta los webhooks que no reciben 200 a tiempo; los
+        # mensajes se procesan y responden después de contestar
+        background_tasks.add_task(_process_senders, by_sender)
         
         return {"status": "ok"}
         
     except Exception as e:
-        logger.error(f"Error en webhook: {str(e)}")
+        logger.error("Error en webhook: %s", e)
         return JSONResponse(
             status_code=500,
             content={"error": "Error interno del servidor"}
@@ -134,13 +232,13 @@ async def verify_webhook(request: Request):
                     status_code=400,
                     content={"error": "Challenge no proporcionado"}
                 )
-            logger.info(f"Webhook verificado exitosamente, devolviendo challenge: {challenge}")
+            logger.info("Webhook verificado exitosamente, devolviendo challenge: %s", challenge)
             return Response(content=challenge, media_type="text/plain")
         
         return JSONResponse(status_code=403, content={"error": "Token inválido"})
         
     except Exception as e:
-        logger.error(f"Error en verificación de webhook: {str(e)}")
+        logger.error("Error en verificación de webhook: %s", e)
         return JSONResponse(
             status_code=500,
             content={"error": "Error interno del servidor"}
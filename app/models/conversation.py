@@ -1,13 +1,21 @@
 """
 Modelos para conversaciones
 """
-from typing import Optional, List, Any, Dict
-from pydantic import BaseModel, ConfigDict
+from collections import deque
+from typing import Optional, List, Any, Dict, Deque, Iterable
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, field_serializer, field_validator
 from datetime import datetime
 from app.utils.constants import ConversationState
 
+# Mensajes recientes que se conservan en memoria; el historial completo
+# queda en la subcolección conversations/{id}/messages
+MAX_MESSAGES = 50
+
 class Message(BaseModel):
     """Modelo para mensajes"""
+    # Los mensajes no se modifican una vez creados
+    model_config = ConfigDict(frozen=True)
+    
     role: str  # user o assistant
     content: str
     original_content: Optional[str] = None
@@ -28,12 +36,40 @@ class Conversation(BaseModel):
     
     id: str
     user_id: str
-    messages: List[Message] = []
+    messages: Deque[Message] = Field(default_factory=lambda: deque(maxlen=MAX_MESSAGES))
     context: ConversationContext = ConversationContext()
     active: bool = True
     created_at: datetime = datetime.now()
     updated_at: datetime = datetime.now()
+    # Si los mensajes recientes ya están en memoria. El documento principal
+    # no guarda mensajes, así que un deque vacío no implica historial vacío
+    _history_loaded: bool = PrivateAttr(default=False)
     
+    @field_validator('messages')
+    @classmethod
+    def cap_messages(cls, messages: Deque[Message]) -> Deque[Message]:
+        """Limita los mensajes en memoria a los MAX_MESSAGES más recientes"""
+        return deque(messages, maxlen=MAX_MESSAGES)
+    
+    @field_serializer('messages')
+    def serialize_messages(self, messages: Deque[Message]) -> List[Message]:
+        """Serializa los mensajes como lista"""
+        return list(messages)
+
+    @property
+    def history_loaded(self) -> bool:
+        """Indica si los mensajes recientes ya se cargaron"""
+        return self._history_loaded
+    
+    def load_history(self, messages: Iterable[Message]) -> None:
+        """Agrega los mensajes recientes leídos de la subcolección"""
+        self.messages.extend(messages)
+        self._history_loaded = True
+
+    def __repr__(self) -> str:
+        """Resumen corto para logs, sin recorrer los mensajes"""
+        return f"Conversation(id={self.id!r}, messages={len(self.messages)}, state={self.context.state!r})"
+
     def add_message(self, role: str, content: str, original_content: Optional[str] = None) -> None:
         """Agrega un mensaje a la conversación"""
         self.messages.append(
@@ -86,6 +122,8 @@ class Conversation(BaseModel):
     def reset(self) -> None:
         """Reinicia la conversación"""
         self.context = ConversationContext()
-        self.messages = []
+        self.messages = deque(maxlen=MAX_MESSAGES)
+        # El historial guardado no se borra; se vuelve a leer cuando se pida
+        self._history_loaded = False
         self.active = True
         self.updated_at = datetime.now()
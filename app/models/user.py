@@ -28,7 +28,7 @@ class User(BaseModel):
     name: Optional[str] = None
     location: Optional[Location] = None
     financial_profile: Optional[FinancialProfile] = None
-    conversation_state: ConversationState = Field(default=ConversationState.INICIO)
+    conversation_state: ConversationState = Field(default=ConversationState.INITIAL)
     data: Dict[str, Any] = Field(default_factory=dict)
     created_at: datetime = Field(default_factory=datetime.now)
     updated_at: datetime = Field(default_factory=datetime.now)
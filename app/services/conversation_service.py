@@ -1,15 +1,62 @@
 from typing import Optional, List, Any
+from collections import deque
+from contextvars import ContextVar
 from datetime import datetime
 import logging
 import uuid
-from app.database.firebase import db
-from app.models.conversation import Conversation, Message
-from app.models.user import User
+from cachetools import TTLCache
+from app.database.firebase import firebase_manager, SERVER_TIMESTAMP
+from app.models.conversation import Conversation, ConversationContext, Message, MAX_MESSAGES
+from app.utils.constants import ConversationState
+from app.utils.batcher import KeyedBatcher
+from app.utils.hydrate import hydrate_conversation, hydrate_messages
 from app.chat.conversation_flow import conversation_flow
 from app.services.whatsapp_service import whatsapp_service
 
 logger = logging.getLogger(__name__)
 
+# Cantidad de mensajes recientes que se cargan con la conversación
+RECENT_MESSAGES_LIMIT = 10
+
+# Estado con el que se guarda una conversación nueva o reiniciada
+_INITIAL_STATE = ConversationState.INITIAL.value
+
+# Conversaciones ya cargadas mientras se procesa un mensaje entrante.
+# handle_message crea un diccionario nuevo por mensaje; fuera de esa
+# invocación el valor es None y no se memoiza nada
+_request_cache: ContextVar[Optional[dict]] = ContextVar('conversation_request_cache', default=None)
+
+def _message_doc(message: Message) -> dict:
+    """Arma el documento de un mensaje sin pasar por model_dump"""
+    return {
+        'role': message.role,
+        'content': message.content,
+        'original_content': message.original_content,
+        'metrics': message.metrics,
+        'timestamp': message.timestamp
+    }
+
+def _initial_context_doc() -> dict:
+    """
+    Arma el contexto guardado de una conversación nueva o reiniciada
+
+    Se devuelve un diccionario nuevo en cada llamada porque las
+    actualizaciones con punto lo modifican en su lugar.
+    """
+    return {
+        'state': _INITIAL_STATE,
+        'collected_data': {},
+        'validation_errors': [],
+        'retry_count': 0,
+        'last_message_timestamp': None
+    }
+
+def _forget_conversation(conversation_id: str) -> None:
+    """Descarta la conversación memoizada para el mensaje actual"""
+    cache = _request_cache.get()
+    if cache:
+        cache.pop(conversation_id, None)
+
 class ConversationService:
     """Servicio para manejar conversaciones de WhatsApp"""
 
@@ -17,94 +64,306 @@ class ConversationService:
         """Inicializa el servicio de conversación"""
         self.flow = conversation_flow
         self.whatsapp = whatsapp_service
-        self.db = db
+        # También guarda el estado de la sesión por teléfono, el mismo que
+        # usa el flujo de conversación
+        self.db = firebase_manager
+        # Comandos especiales, indexados por el mensaje normalizado
+        self._commands = {
+            'inicio': self.restart_conversation,
+            'ayuda': self.show_help,
+            'asesor': self.connect_to_advisor
+        }
+        # Caché en proceso user_id -> conversación activa. Solo es coherente
+        # con un único proceso; en despliegues con varias instancias debe
+        # acompañarse de invalidación distribuida (p.ej. Redis pub/sub).
+        self._active_cache: TTLCache = TTLCache(maxsize=10_000, ttl=300)
+        # user_id -> ID de la conversación activa. Sobrevive a las
+        # invalidaciones de _active_cache y sirve como pista para leer el
+        # usuario y la conversación en un solo lote
+        self._active_ids: TTLCache = TTLCache(maxsize=1000, ttl=600)
+        # Caché corto de conversaciones por ID para las ráfagas de mensajes;
+        # cada escritura lo actualiza o invalida
+        self._conversation_cache: TTLCache = TTLCache(maxsize=2048, ttl=30)
+        # Los mensajes que llegan juntos a una conversación se escriben en
+        # un solo lote
+        self._message_batcher = KeyedBatcher(self._write_messages)
     
     async def create_conversation(self, user_id: str) -> Conversation:
         """Create a new conversation for a user"""
-        conversation = Conversation(
+        # users.active_conversation identifica la conversación anterior, así
+        # cerrarla y abrir la nueva cabe en un solo lote sin consultar la colección
+        user_data = await self.db.get_document('users', user_id)
+        previous_id = user_data.get('active_conversation') if user_data else None
+        
+        now = datetime.now()
+        conversation = Conversation.model_construct(
             id=str(uuid.uuid4()),
             user_id=user_id,
-            messages=[],
-            context={
-                'state': 'initial',
-                'collected_data': {},
-                'current_crop': None
-            }
+            messages=deque(maxlen=MAX_MESSAGES),
+            context=ConversationContext(),
+            active=True,
+            created_at=now,
+            updated_at=now
         )
+        # Una conversación nueva no tiene historial que cargar
+        conversation.load_history(())
+        # El documento se arma directamente: todos los valores son conocidos
+        conv_doc = {
+            'id': conversation.id,
+            'user_id': user_id,
+            'messages': [],
+            'context': _initial_context_doc(),
+            'active': True,
+            'created_at': now,
+            'updated_at': now
+        }
         
-        await self.db.add_document('conversations', conversation.model_dump(), conversation.id)
+        # La conversación y el puntero del usuario se escriben juntos para
+        # que users.active_conversation sea siempre la fuente de verdad
+        writes = [
+            ('conversations', conversation.id, conv_doc),
+            ('users', user_id, {'active_conversation': conversation.id})
+        ]
+        if previous_id:
+            writes.append(('conversations', previous_id, {'active': False}))
+        await self.db.batch_set(writes)
+        if previous_id:
+            self._invalidate(previous_id)
+        self._active_cache[user_id] = conversation
+        self._active_ids[user_id] = conversation.id
+        self._conversation_cache[conversation.id] = conversation
         return conversation
     
-    async def get_active_conversation(self, user_id: str) -> Optional[Conversation]:
-        """Get the active conversation for a user"""
-        conversations = await self.db.query_collection(
-            'conversations',
-            'user_id',
-            '==',
-            user_id
-        )
+    def _invalidate(self, conversation_id: str) -> None:
+        """Descarta las copias en caché de una conversación por ID"""
+        _forget_conversation(conversation_id)
+        self._conversation_cache.pop(conversation_id, None)
+    
+    async def _get_conversation_data(self, conversation_id: str) -> dict:
+        """Obtiene el documento de la conversación o lanza ValueError"""
+        conv_data = await self.db.get_document('conversations', conversation_id)
+        if not conv_data:
+            raise ValueError(f"Conversation {conversation_id} not found")
+        return conv_data
+    
+    async def get_conversation(self, conversation_id: str, with_messages: bool = False) -> Conversation:
+        """
+        Get a conversation by id
         
-        active_conversations = [
-            Conversation(**conv) for conv in conversations 
-            if conv.get('active', False)
-        ]
+        Args:
+            conversation_id: ID de la conversación
+            with_messages: Si se cargan los mensajes recientes de la
+                subcolección; el documento principal no los contiene
+        """
+        cache = _request_cache.get()
+        conversation = cache.get(conversation_id) if cache is not None else None
+        
+        if conversation is None:
+            conversation = self._conversation_cache.get(conversation_id)
+        if conversation is None:
+            conv_data = await self._get_conversation_data(conversation_id)
+            conversation = hydrate_conversation(conv_data)
+            self._conversation_cache[conversation_id] = conversation
+            logger.debug("Conversación %s cargada, estado: %s", conversation_id, conversation.context.state)
         
-        return active_conversations[0] if active_conversations else None
+        if with_messages and not conversation.history_loaded:
+            conversation.load_history(await self.get_recent_messages(conversation_id))
+        
+        if cache is not None:
+            cache[conversation_id] = conversation
+        return conversation
     
-    async def add_message(self, conversation_id: str, role: str, content: str):
-        """Add a message to a conversation"""
-        message = Message(role=role, content=content)
+    async def get_active_conversation(self, user_id: str, conversation_id: Optional[str] = None) -> Optional[Conversation]:
+        """
+        Get the active conversation for a user
         
-        # Get current conversation
-        conv_data = await self.db.get_document('conversations', conversation_id)
+        Args:
+            user_id: ID del usuario
+            conversation_id: ID de la conversación que se cree activa, si el
+                llamador ya lo conoce; permite leer ambos documentos juntos
+        """
+        cached = self._active_cache.get(user_id)
+        if cached is not None:
+            return cached
+        
+        if conversation_id is None:
+            conversation_id = self._active_ids.get(user_id)
+        
+        # users.active_conversation se mantiene al escribir, así basta con
+        # leer documentos por ID en lugar de consultar la colección
+        conv_data = None
+        if conversation_id:
+            user_data, conv_data = await self.db.get_documents([
+                ('users', user_id),
+                ('conversations', conversation_id)
+            ])
+        else:
+            user_data = await self.db.get_document('users', user_id)
+        
+        active_id = user_data.get('active_conversation') if user_data else None
+        if not active_id:
+            self._active_ids.pop(user_id, None)
+            return None
+        if active_id != conversation_id:
+            conv_data = await self.db.get_document('conversations', active_id)
         if not conv_data:
-            raise ValueError(f"Conversation {conversation_id} not found")
+            return None
         
-        conversation = Conversation(**conv_data)
-        conversation.messages.append(message)
-        conversation.updated_at = datetime.now()
+        conversation = hydrate_conversation(conv_data)
+        conversation.load_history(await self.get_recent_messages(conversation.id))
+        self._active_cache[user_id] = conversation
+        self._active_ids[user_id] = conversation.id
+        self._conversation_cache[conversation.id] = conversation
+        return conversation
+    
+    async def add_message(self, conversation_id: str, role: str, content: str, user_id: Optional[str] = None):
+        """
+        Add a message to a conversation
         
-        # Update in database
-        await self.db.update_document(
-            'conversations',
-            conversation_id,
-            {'messages': [m.model_dump() for m in conversation.messages],
-             'updated_at': conversation.updated_at}
-        )
+        Args:
+            conversation_id: ID de la conversación
+            role: user o assistant
+            content: Texto del mensaje
+            user_id: Dueño de la conversación, si el llamador lo conoce; sin
+                él solo se actualiza la conversación activa si ya está en caché
+        """
+        message = Message(role=role, content=content, timestamp=datetime.now())
+        
+        await self._message_batcher.submit(conversation_id, message)
         
+        # Mantener las copias en memoria al día sin leer la conversación. Las
+        # que no tienen el historial cargado no reciben el mensaje: lo leerán
+        # de la subcolección junto con los anteriores
+        cache = _request_cache.get()
+        copies = [
+            c for c in (
+                cache.get(conversation_id) if cache is not None else None,
+                self._conversation_cache.get(conversation_id)
+            )
+            if c is not None
+        ]
+        if user_id is None and copies:
+            user_id = copies[0].user_id
+        cached = self._active_cache.get(user_id) if user_id is not None else None
+        if cached is not None and cached.id == conversation_id:
+            copies.append(cached)
+        
+        # Las copias hechas con model_copy comparten el deque de mensajes
+        updated = set()
+        for copy in copies:
+            if copy.history_loaded and id(copy.messages) not in updated:
+                copy.messages.append(message)
+                updated.add(id(copy.messages))
+            copy.updated_at = message.timestamp
+        
+        logger.debug("Mensaje agregado conv=%s role=%s len=%d", conversation_id, role, len(content))
         return message
     
+    async def _write_messages(self, conversation_id: str, messages: List[Message]) -> None:
+        """
+        Escribe un lote de mensajes de una conversación
+        
+        Cada mensaje es un documento de la subcolección, así la escritura no
+        depende del tamaño del historial.
+        """
+        # Los mensajes y la hora del documento principal van en el mismo lote
+        collection = f'conversations/{conversation_id}/messages'
+        writes = [(collection, str(uuid.uuid4()), _message_doc(m)) for m in messages]
+        writes.append(('conversations', conversation_id, {'updated_at': SERVER_TIMESTAMP}))
+        await self.db.batch_set(writes)
+    
+    async def get_recent_messages(self, conversation_id: str, n: int = RECENT_MESSAGES_LIMIT) -> List[Message]:
+        """
+        Obtiene los últimos mensajes de una conversación
+        
+        Args:
+            conversation_id: ID de la conversación
+            n: Cantidad máxima de mensajes
+            
+        Returns:
+            List[Message]: Mensajes en orden cronológico
+        """
+        messages = await self.db.get_collection(
+            f'conversations/{conversation_id}/messages',
+            order_by='timestamp',
+            descending=True,
+            limit=n
+        )
+        return hydrate_messages(reversed(messages))
+    
     async def update_context(self, conversation_id: str, context_updates: dict):
         """Update the conversation context"""
         try:
-            conv_data = await self.db.get_document('conversations', conversation_id)
-            if not conv_data:
-                raise ValueError(f"Conversation {conversation_id} not found")
-            
-            conversation = Conversation(**conv_data)
-            conversation.context.update(context_updates)
-            conversation.updated_at = datetime.now()
-            
-            await self.db.update_document(
-                'conversations',
-                conversation_id,
-                {'context': conversation.context,
-                 'updated_at': conversation.updated_at}
-            )
+            # Validar antes de leer o escribir nada
+            unknown = context_updates.keys() - ConversationContext.model_fields.keys()
+            if unknown:
+                raise ValueError(f"Unknown context fields: {sorted(unknown)}")
+            if 'state' in context_updates:
+                state = ConversationState(context_updates['state'])
+                context_updates = {**context_updates, 'state': state}
+            
+            current = await self.get_conversation(conversation_id)
+            if not context_updates:
+                return current.context
+            
+            # Copia nueva: quien ya tenga la conversación no ve el cambio a medias
+            context = current.context.model_copy(update=context_updates)
+            conversation = current.model_copy(update={'context': context})
+            
+            # Solo se escriben los campos modificados del contexto
+            fields = {f'context.{key}': value for key, value in context_updates.items()}
+            fields['updated_at'] = SERVER_TIMESTAMP
+            await self.db.update_document('conversations', conversation_id, fields)
+            _forget_conversation(conversation_id)
+            self._conversation_cache[conversation_id] = conversation
+            
+            # La conversación activa conserva sus mensajes; solo cambia el contexto
+            cached = self._active_cache.get(conversation.user_id)
+            if cached is not None and cached.id == conversation_id:
+                self._active_cache[conversation.user_id] = (
+                    conversation if cached is current
+                    else cached.model_copy(update={'context': context})
+                )
             
             return conversation.context
         except Exception as e:
-            logger.error(f"Error updating context: {str(e)}")
+            logger.error("Error updating context: %s", e)
             raise
     
     async def end_conversation(self, conversation_id: str):
         """End a conversation"""
-        await self.db.update_document(
-            'conversations',
-            conversation_id,
-            {'active': False,
-             'updated_at': datetime.now()}
-        )
+        conv_data = await self.db.get_document('conversations', conversation_id)
+        if not conv_data:
+            return False
+        
+        user_id = conv_data.get('user_id')
+        writes = [('conversations', conversation_id, {'active': False})]
+        user_data = await self.db.get_document('users', user_id)
+        if user_data and user_data.get('active_conversation') == conversation_id:
+            writes.append(('users', user_id, {'active_conversation': None}))
+        
+        await self.db.batch_set(writes)
+        self._active_cache.pop(user_id, None)
+        self._active_ids.pop(user_id, None)
+        self._invalidate(conversation_id)
+        
+        return True
+    
+    async def reset_conversation(self, conversation_id: str):
+        """Reset the context of a conversation, keeping its message history"""
+        user_id = (await self.get_conversation(conversation_id)).user_id
+        
+        # El contexto se escribe completo: no depende de cómo combine el lote
+        # los mapas anidados con el contexto guardado
+        await self.db.batch_set([
+            ('conversations', conversation_id,
+             {'context': _initial_context_doc(), 'active': True}),
+            ('users', user_id, {'active_conversation': conversation_id})
+        ])
+        self._invalidate(conversation_id)
+        self._active_cache.pop(user_id, None)
+        self._active_ids[user_id] = conversation_id
+        logger.debug("Conversación %s reiniciada", conversation_id)
         
         return True
 
@@ -116,45 +375,42 @@ class ConversationService:
             phone_number: Número de teléfono del usuario
             message: Mensaje recibido
         """
+        token = _request_cache.set({})
         try:
             # Normalizar mensaje
             message = message.strip()
             
             # Si es comando especial, procesar
-            if message.lower() == 'inicio':
-                await self.restart_conversation(phone_number)
-                return
-                
-            if message.lower() == 'ayuda':
-                await self.show_help(phone_number)
-                return
-                
-            if message.lower() == 'asesor':
-                await self.connect_to_advisor(phone_number)
+            handler = self._commands.get(message.casefold())
+            if handler:
+                await handler(phone_number)
                 return
             
             # Procesar mensaje normal
             await self.flow.process_message(phone_number, message)
             
         except Exception as e:
-            logger.error(f"Error en handle_message: {str(e)}")
+            logger.error("Error en handle_message: %s", e)
             await self.whatsapp.send_message(
                 phone_number,
                 "Lo siento, hubo un error. Por favor escriba 'inicio' para empezar de nuevo."
             )
+        finally:
+            _request_cache.reset(token)
 
     async def restart_conversation(self, phone_number: str) -> None:
         """Reinicia la conversación"""
         try:
             # Limpiar datos del usuario
-            self.flow.user_data[phone_number] = {'data': {}, 'state': 'start'}
+            await self.db.clear_user_cache(phone_number)
+            await self.db.update_conversation_state(phone_number, {'data': {}, 'state': 'start'})
             
             # Enviar mensaje de bienvenida
             welcome = self.flow.start_conversation()
             await self.whatsapp.send_message(phone_number, welcome)
             
         except Exception as e:
-            logger.error(f"Error reiniciando conversación: {str(e)}")
+            logger.error("Error reiniciando conversación: %s", e)
             await self.whatsapp.send_message(
                 phone_number,
                 "Lo siento, hubo un error. Por favor intente de nuevo."
@@ -164,14 +420,14 @@ class ConversationService:
         """Muestra mensaje de ayuda"""
         try:
             # Obtener estado actual
-            user_data = self.flow.user_data.get(phone_number, {'data': {}})
+            user_data = await self.db.get_conversation_state(phone_number)
             
             # Obtener ayuda contextual
             help_message = self.flow.show_help(user_data)
             await self.whatsapp.send_message(phone_number, help_message)
             
         except Exception as e:
-            logger.error(f"Error mostrando ayuda: {str(e)}")
+            logger.error("Error mostrando ayuda: %s", e)
             await self.whatsapp.send_message(
                 phone_number,
                 "Lo siento, hubo un error. Por favor escriba 'inicio' para empezar de nuevo."
@@ -181,17 +437,17 @@ class ConversationService:
         """Conecta con un asesor"""
         try:
             # Obtener datos del usuario
-            user_data = self.flow.user_data.get(phone_number, {'data': {}})
+            user_data = await self.db.get_conversation_state(phone_number)
             
             # Conectar con asesor
             message = self.flow.connect_to_advisor(user_data)
             await self.whatsapp.send_message(phone_number, message)
             
             # Guardar datos actualizados
-            self.flow.user_data[phone_number] = user_data
+            await self.db.update_conversation_state(phone_number, user_data)
             
         except Exception as e:
-            logger.error(f"Error conectando con asesor: {str(e)}")
+            logger.error("Error conectando con asesor: %s", e)
             await self.whatsapp.send_message(
                 phone_number,
                 "Lo siento, hubo un error. Por favor escriba 'inicio' para empezar de nuevo."
@@ -1,27 +1,30 @@
 import os
-import requests
+import logging
+import httpx
 from typing import Optional, List
 from dotenv import load_dotenv
 
+from app.services.whatsapp_service import post_json, close_client, normalize_phone
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 class WhatsAppCloudAPI:
     def __init__(self):
         self.phone_number_id = os.getenv('WHATSAPP_PHONE_NUMBER_ID')
         self.access_token = os.getenv('WHATSAPP_ACCESS_TOKEN')
         self.api_version = 'v21.0'
-        self.api_url = f'https://graph.facebook.com/{self.api_version}/{self.phone_number_id}/messages'
-
-    def _get_headers(self) -> dict[str, str]:
-        """Retorna los headers necesarios para la API de WhatsApp"""
-        return {
+        self.api_url = httpx.URL(f'https://graph.facebook.com/{self.api_version}/{self.phone_number_id}/messages')
+        # El token no cambia durante la vida de la instancia
+        self._headers = {
             'Authorization': f'Bearer {self.access_token}',
             'Content-Type': 'application/json'
         }
 
-    def send_text_message(self, to_number: str, message: str) -> dict:
+    async def send_text_message(self, to_number: str, message: str) -> dict:
         """Envía un mensaje de texto simple"""
-        to_number = to_number.lstrip('+')
+        to_number = normalize_phone(to_number)
         
         payload = {
             "messaging_product": "whatsapp",
@@ -35,21 +38,17 @@ class WhatsAppCloudAPI:
         }
         
         try:
-            response = requests.post(
-                self.api_url,
-                headers=self._get_headers(),
-                json=payload
-            )
+            response = await post_json(self.api_url, payload, headers=self._headers)
             response.raise_for_status()
             return response.json()
             
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending message: {str(e)}")
-            if hasattr(e, 'response'):
-                print(f"Server response: {e.response.text}")
+        except httpx.HTTPError as e:
+            logger.error("Error sending message: %s", e)
+            if isinstance(e, httpx.HTTPStatusError):
+                logger.error("Server response: %s", e.response.text)
             raise e
 
-    def send_template_message(
+    async def send_template_message(
         self, 
         to_number: str, 
         template_name: str, 
@@ -57,7 +56,7 @@ class WhatsAppCloudAPI:
         components: Optional[List[dict]] = None
     ) -> dict:
         """Envía un mensaje de plantilla con componentes opcionales"""
-        to_number = to_number.lstrip('+')
+        to_number = normalize_phone(to_number)
         
         template = {
             "name": template_name,
@@ -77,27 +76,23 @@ class WhatsAppCloudAPI:
         }
         
         try:
-            response = requests.post(
-                self.api_url,
-                headers=self._get_headers(),
-                json=payload
-            )
+            response = await post_json(self.api_url, payload, headers=self._headers)
             response.raise_for_status()
             return response.json()
             
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending template message: {str(e)}")
-            if hasattr(e, 'response'):
-                print(f"Server response: {e.response.text}")
+        except httpx.HTTPError as e:
+            logger.error("Error sending template message: %s", e)
+            if isinstance(e, httpx.HTTPStatusError):
+                logger.error("Server response: %s", e.response.text)
             raise e
 
-    def send_interactive_message(
+    async def send_interactive_message(
         self, 
         to_number: str, 
         interactive_data: dict
     ) -> dict:
         """Envía un mensaje interactivo (botones, listas, etc.)"""
-        to_number = to_number.lstrip('+')
+        to_number = normalize_phone(to_number)
         
         payload = {
             "messaging_product": "whatsapp",
@@ -108,28 +103,24 @@ class WhatsAppCloudAPI:
         }
         
         try:
-            response = requests.post(
-                self.api_url,
-                headers=self._get_headers(),
-                json=payload
-            )
+            response = await post_json(self.api_url, payload, headers=self._headers)
             response.raise_for_status()
             return response.json()
             
-        except requests.exceptions.RequestException as e:
-            print(f"Error sending interactive message: {str(e)}")
-            if hasattr(e, 'response'):
-                print(f"Server response: {e.response.text}")
+        except httpx.HTTPError as e:
+            logger.error("Error sending interactive message: %s", e)
+            if isinstance(e, httpx.HTTPStatusError):
+                logger.error("Server response: %s", e.response.text)
             raise e
 
-    def send_location_request(self, to_number: str) -> dict:
+    async def send_location_request(self, to_number: str) -> dict:
         """Envía una solicitud de ubicación"""
-        return self.send_text_message(
+        return await self.send_text_message(
             to_number,
             "📍 Por favor, comparte tu ubicación para poder darte información más precisa."
         )
 
-    def send_list_message(
+    async def send_list_message(
         self, 
         to_number: str, 
         header: str,
@@ -157,9 +148,9 @@ class WhatsAppCloudAPI:
             }
         }
         
-        return self.send_interactive_message(to_number, interactive_data)
+        return await self.send_interactive_message(to_number, interactive_data)
 
-    def send_button_message(
+    async def send_button_message(
         self, 
         to_number: str, 
         header: str,
@@ -185,9 +176,9 @@ class WhatsAppCloudAPI:
             }
         }
         
-        return self.send_interactive_message(to_number, interactive_data)
+        return await self.send_interactive_message(to_number, interactive_data)
 
-    def mark_message_as_read(self, message_id: str) -> dict:
+    async def mark_message_as_read(self, message_id: str) -> dict:
         """Marca un mensaje como leído"""
         payload = {
             "messaging_product": "whatsapp",
@@ -196,16 +187,16 @@ class WhatsAppCloudAPI:
         }
         
         try:
-            response = requests.post(
-                self.api_url,
-                headers=self._get_headers(),
-                json=payload
-            )
+            response = await post_json(self.api_url, payload, headers=self._headers)
             response.raise_for_status()
             return response.json()
             
-        except requests.exceptions.RequestException as e:
-            print(f"Error marking message as read: {str(e)}")
-            if hasattr(e, 'response'):
-                print(f"Server response: {e.response.text}")
+        except httpx.HTTPError as e:
+            logger.error("Error marking message as read: %s", e)
+            if isinstance(e, httpx.HTTPStatusError):
+                logger.error("Server response: %s", e.response.text)
             raise e
+
+    async def close(self) -> None:
+        """Cierra el cliente HTTP compartido"""
+        await close_client()
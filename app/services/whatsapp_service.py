@@ -1,15 +1,136 @@
 """
 Servicio para interactuar con la API de WhatsApp
 """
+import asyncio
 import logging
+import random
 import httpx
-from typing import Dict, Any, Optional, List
+import orjson
+from typing import Dict, Any, Optional, List, Union
 from datetime import datetime
 
 from app.config import settings
 
 logger = logging.getLogger(__name__)
 
+# Cliente HTTP compartido por todas las instancias del servicio. Mantiene
+# abiertas las conexiones con la API de Graph entre envíos
+_client: Optional[httpx.AsyncClient] = None
+
+# Reintentos ante fallas de conexión con la API de Graph
+CONNECT_RETRIES = 2
+
+# Conexiones simultáneas del pool. Los envíos que excedan el límite esperan
+# en _send_slots, fuera del pool, así la espera no consume el timeout de httpx
+MAX_CONNECTIONS = 100
+_send_slots = asyncio.Semaphore(MAX_CONNECTIONS)
+
+# Respuestas con las que Graph indica que no procesó el mensaje; solo esas
+# se reenvían, así un reintento nunca duplica un mensaje entregado
+RETRY_STATUSES = frozenset({429, 503})
+MAX_SEND_ATTEMPTS = 3
+MAX_RETRY_DELAY = 4.0
+
+async def get_client() -> httpx.AsyncClient:
+    """
+    Obtiene el cliente HTTP compartido, creándolo si hace falta
+    
+    Returns:
+        httpx.AsyncClient: Cliente con los headers de autenticación ya configurados
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        # El transporte reintenta solo las fallas al conectar: en ese punto
+        # no se ha enviado nada y reintentar un POST no duplica mensajes
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=CONNECT_RETRIES,
+            limits=httpx.Limits(
+                max_keepalive_connections=20,
+                max_connections=MAX_CONNECTIONS,
+                keepalive_expiry=60.0
+            )
+        )
+        _client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(10.0, connect=3.0),
+            headers={
+                "Authorization": f"Bearer {settings.WHATSAPP_TOKEN}",
+                "Content-Type": "application/json",
+                "Accept-Encoding": "gzip"
+            }
+        )
+    return _client
+
+def _retry_delay(response: httpx.Response, attempt: int) -> float:
+    """Segundos de espera antes del siguiente intento, respetando Retry-After"""
+    retry_after = response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return min(float(retry_after), MAX_RETRY_DELAY)
+    delay = 0.25 * 2 ** attempt
+    return min(delay + random.uniform(0, delay), MAX_RETRY_DELAY)
+
+async def post_json(
+    url: Union[httpx.URL, str],
+    payload: Dict[str, Any],
+    headers: Optional[Dict[str, str]] = None
+) -> httpx.Response:
+    """
+    Envía un payload a la API de Graph con el cliente compartido
+    
+    Los rechazos temporales (429/503) se reintentan con espera exponencial;
+    la última respuesta se devuelve tal cual para que el llamador la valide.
+    
+    Args:
+        url: Endpoint de Graph, de preferencia ya parseado con httpx.URL
+        payload: Cuerpo del mensaje
+        headers: Headers adicionales a los del cliente compartido
+        
+    Returns:
+        httpx.Response: Respuesta del último intento
+    """
+    client = await get_client()
+    content = orjson.dumps(payload)
+    for attempt in range(MAX_SEND_ATTEMPTS):
+        try:
+            async with _send_slots:
+                response = await client.post(url, content=content, headers=headers)
+        # Los timeouts se registran aparte de los errores de la API: indican
+        # un pool mal dimensionado o una red lenta, no un mensaje rechazado
+        except httpx.PoolTimeout:
+            logger.warning("Pool de conexiones agotado esperando enviar a Graph")
+            raise
+        except httpx.TimeoutException as e:
+            logger.warning("Timeout enviando a Graph: %s", type(e).__name__)
+            raise
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_SEND_ATTEMPTS - 1:
+            return response
+        delay = _retry_delay(response, attempt)
+        logger.warning("Graph respondió %s, reintentando en %.2fs", response.status_code, delay)
+        await asyncio.sleep(delay)
+
+# Caracteres que la API de Graph rechaza en el número destino
+_PHONE_STRIP = str.maketrans('', '', '+ -()')
+
+def normalize_phone(phone: str) -> str:
+    """
+    Deja solo los dígitos del número destino en una sola pasada
+    
+    Args:
+        phone: Número como llega del usuario o del webhook, p. ej. "+502 5555-1234"
+        
+    Returns:
+        str: Número sin '+', espacios, guiones ni paréntesis
+    """
+    return phone.translate(_PHONE_STRIP)
+
+async def close_client() -> None:
+    """Cierra el cliente HTTP compartido"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 class WhatsAppService:
     """Servicio para interactuar con la API de WhatsApp"""
     
@@ -18,9 +139,10 @@ class WhatsAppService:
         self.api_url = "https://graph.facebook.com/v17.0"
         self.phone_number_id = settings.WHATSAPP_PHONE_ID
         self.access_token = settings.WHATSAPP_TOKEN
-        self.client = httpx.AsyncClient(timeout=30.0)
+        # Se parsea una sola vez; httpx reutiliza el URL ya parseado en cada envío
+        self.messages_url = httpx.URL(f"{self.api_url}/{self.phone_number_id}/messages")
     
-    async def send_message(self, to: str, message: str) -> Dict[str, Any]:
+    async def send_message(self, to: str, message: str) -> bool:
         """
         Envía un mensaje de texto por WhatsApp
         
@@ -29,40 +151,35 @@ class WhatsAppService:
             message: Mensaje a enviar
             
         Returns:
-            Dict con la respuesta de la API
+            bool: True si la API aceptó el mensaje
         """
         try:
             # Preparar payload
             payload = {
                 "messaging_product": "whatsapp",
                 "recipient_type": "individual",
-                "to": to,
+                "to": normalize_phone(to),
                 "type": "text",
                 "text": {"body": message}
             }
             
             # Enviar mensaje
-            response = await self.client.post(
-                f"{self.api_url}/{self.phone_number_id}/messages",
-                json=payload,
-                headers={
-                    "Authorization": f"Bearer {self.access_token}",
-                    "Content-Type": "application/json"
-                }
-            )
+            response = await post_json(self.messages_url, payload)
             
-            # Validar respuesta
+            # Validar respuesta; el cuerpo solo se lee al depurar
             response.raise_for_status()
-            return response.json()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Respuesta de WhatsApp: %s", response.text)
+            return True
             
         except httpx.HTTPError as e:
-            logger.error(f"Error enviando mensaje: {str(e)}")
-            if e.response:
-                logger.error(f"Response: {e.response.text}")
+            logger.error("Error enviando mensaje: %s", e)
+            if isinstance(e, httpx.HTTPStatusError):
+                logger.error("Response: %s", e.response.text)
             raise
             
         except Exception as e:
-            logger.error(f"Error inesperado: {str(e)}")
+            logger.error("Error inesperado: %s", e)
             raise
     
     async def send_template(
@@ -71,7 +188,7 @@ class WhatsAppService:
         template_name: str,
         language_code: str = "es",
         components: Optional[List[Dict[str, Any]]] = None
-    ) -> Dict[str, Any]:
+    ) -> bool:
         """
         Envía un mensaje usando una plantilla
         
@@ -82,14 +199,14 @@ class WhatsAppService:
             components: Componentes de la plantilla
             
         Returns:
-            Dict con la respuesta de la API
+            bool: True si la API aceptó el mensaje
         """
         try:
             # Preparar payload
             payload = {
                 "messaging_product": "whatsapp",
                 "recipient_type": "individual",
-                "to": to,
+                "to": normalize_phone(to),
                 "type": "template",
                 "template": {
                     "name": template_name,
@@ -104,27 +221,22 @@ class WhatsAppService:
                 payload["template"]["components"] = components
             
             # Enviar mensaje
-            response = await self.client.post(
-                f"{self.api_url}/{self.phone_number_id}/messages",
-                json=payload,
-                headers={
-                    "Authorization": f"Bearer {self.access_token}",
-                    "Content-Type": "application/json"
-                }
-            )
+            response = await post_json(self.messages_url, payload)
             
-            # Validar respuesta
+            # Validar respuesta; el cuerpo solo se lee al depurar
             response.raise_for_status()
-            return response.json()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Respuesta de WhatsApp: %s", response.text)
+            return True
             
         except httpx.HTTPError as e:
-            logger.error(f"Error enviando template: {str(e)}")
-            if e.response:
-                logger.error(f"Response: {e.response.text}")
+            logger.error("Error enviando template: %s", e)
+            if isinstance(e, httpx.HTTPStatusError):
+                logger.error("Response: %s", e.response.text)
             raise
             
         except Exception as e:
-            logger.error(f"Error inesperado: {str(e)}")
+            logger.error("Error inesperado: %s", e)
             raise
     
     async def send_interactive(
@@ -135,7 +247,7 @@ class WhatsAppService:
         body: Optional[Dict[str, Any]] = None,
         footer: Optional[Dict[str, Any]] = None,
         action: Optional[Dict[str, Any]] = None
-    ) -> Dict[str, Any]:
+    ) -> bool:
         """
         Envía un mensaje interactivo
         
@@ -148,14 +260,14 @@ class WhatsAppService:
             action: Acción opcional
             
         Returns:
-            Dict con la respuesta de la API
+            bool: True si la API aceptó el mensaje
         """
         try:
             # Preparar payload
             payload = {
                 "messaging_product": "whatsapp",
                 "recipient_type": "individual",
-                "to": to,
+                "to": normalize_phone(to),
                 "type": "interactive",
                 "interactive": {
                     "type": interactive_type
@@ -173,27 +285,22 @@ class WhatsAppService:
                 payload["interactive"]["action"] = action
             
             # Enviar mensaje
-            response = await self.client.post(
-                f"{self.api_url}/{self.phone_number_id}/messages",
-                json=payload,
-                headers={
-                    "Authorization": f"Bearer {self.access_token}",
-                    "Content-Type": "application/json"
-                }
-            )
+            response = await post_json(self.messages_url, payload)
             
-            # Validar respuesta
+            # Validar respuesta; el cuerpo solo se lee al depurar
             response.raise_for_status()
-            return response.json()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Respuesta de WhatsApp: %s", response.text)
+            return True
             
         except httpx.HTTPError as e:
-            logger.error(f"Error enviando mensaje interactivo: {str(e)}")
-            if e.response:
-                logger.error(f"Response: {e.response.text}")
+            logger.error("Error enviando mensaje interactivo: %s", e)
+            if isinstance(e, httpx.HTTPStatusError):
+                logger.error("Response: %s", e.response.text)
             raise
             
         except Exception as e:
-            logger.error(f"Error inesperado: {str(e)}")
+            logger.error("Error inesperado: %s", e)
             raise
     
     async def process_message(self, from_number: str, message: Dict[str, Any]) -> None:
@@ -297,15 +404,15 @@ class WhatsAppService:
             )
             
         except Exception as e:
-            logger.error(f"Error procesando mensaje: {str(e)}")
+            logger.error("Error procesando mensaje: %s", e)
             await self.send_message(
                 from_number,
                 "❌ Ha ocurrido un error. Por favor intenta de nuevo más tarde."
             )
 
     async def close(self):
-        """Cierra el cliente HTTP"""
-        await self.client.aclose()
+        """Cierra el cliente HTTP compartido"""
+        await close_client()
 
 # Instancia global
 whatsapp_service = WhatsAppService()
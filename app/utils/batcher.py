@@ -0,0 +1,78 @@
+"""
+Agrupación de escrituras concurrentes por clave
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+class KeyedBatcher:
+    """
+    Agrupa los elementos enviados para una misma clave durante una ventana
+    corta y los entrega juntos a una sola función de escritura.
+
+    Cada clave tiene un único escritor, así se conserva el orden de llegada.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[str, List[Any]], Awaitable[None]],
+        window: float = 0.02,
+        max_batch: int = 25
+    ):
+        """
+        Args:
+            flush: Función que escribe los elementos acumulados de una clave
+            window: Segundos que se espera para acumular elementos
+            max_batch: Cantidad de elementos que dispara la escritura inmediata
+        """
+        self._flush = flush
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: Dict[str, List[Tuple[Any, asyncio.Future]]] = {}
+        self._full: Dict[str, asyncio.Event] = {}
+        self._workers: Dict[str, asyncio.Task] = {}
+
+    async def submit(self, key: str, item: Any) -> None:
+        """
+        Agrega un elemento y espera a que quede escrito
+
+        Args:
+            key: Clave del lote (p.ej. ID de la conversación)
+            item: Elemento a escribir
+        """
+        future = asyncio.get_running_loop().create_future()
+        pending = self._pending.setdefault(key, [])
+        pending.append((item, future))
+
+        if key not in self._workers:
+            self._full[key] = asyncio.Event()
+            self._workers[key] = asyncio.create_task(self._run(key))
+        if len(pending) >= self.max_batch:
+            self._full[key].set()
+
+        await future
+
+    async def _run(self, key: str) -> None:
+        """Escribe los lotes de una clave hasta que no queden pendientes"""
+        try:
+            while self._pending.get(key):
+                full = self._full[key]
+                try:
+                    await asyncio.wait_for(full.wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+                full.clear()
+
+                batch = self._pending.pop(key, [])
+                try:
+                    await self._flush(key, [item for item, _ in batch])
+                except Exception as e:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for _, future in batch:
+                        if not future.done():
+                            future.set_result(None)
+        finally:
+            self._workers.pop(key, None)
+            self._full.pop(key, None)
@@ -0,0 +1,66 @@
+"""
+Construcción de modelos a partir de documentos guardados
+"""
+from collections import deque
+from datetime import datetime
+from typing import Any, Iterable, List
+
+from app.models.conversation import Conversation, ConversationContext, Message, MAX_MESSAGES
+
+_ISO = datetime.fromisoformat
+
+_TIMESTAMP_FIELDS = ('created_at', 'updated_at')
+
+def parse_ts(value: Any) -> Any:
+    """
+    Convierte una marca de tiempo ISO guardada como texto a datetime
+
+    Los documentos escritos por la aplicación ya guardan datetime; los
+    textos vienen de documentos antiguos o de otro backend. El sufijo 'Z'
+    se traduce porque fromisoformat no lo acepta en Python 3.10.
+    """
+    if value.__class__ is str:
+        if value[-1:] == 'Z':
+            value = value[:-1] + '+00:00'
+        return _ISO(value)
+    return value
+
+def _parse_timestamps(data: dict) -> None:
+    """Normaliza created_at/updated_at del documento en su lugar"""
+    for field in _TIMESTAMP_FIELDS:
+        if field in data:
+            data[field] = parse_ts(data[field])
+
+def hydrate_messages(raw: Iterable[dict]) -> List[Message]:
+    """
+    Construye los mensajes guardados normalizando su marca de tiempo
+
+    Se usa model_construct: los campos ya tienen el tipo correcto y validar
+    cada mensaje domina el costo en conversaciones largas.
+    """
+    return [
+        Message.model_construct(
+            role=m['role'],
+            content=m['content'],
+            original_content=m.get('original_content'),
+            metrics=m.get('metrics'),
+            timestamp=parse_ts(m['timestamp'])
+        )
+        for m in raw
+    ]
+
+def hydrate_conversation(raw: dict) -> Conversation:
+    """
+    Construye una conversación guardada sin volver a validarla con Pydantic
+
+    Args:
+        raw: Documento de la colección conversations
+
+    Returns:
+        Conversation: Conversación con fechas y mensajes normalizados
+    """
+    data = dict(raw)
+    data['context'] = ConversationContext.model_construct(**(data.get('context') or {}))
+    data['messages'] = deque(hydrate_messages(data.get('messages') or ()), maxlen=MAX_MESSAGES)
+    _parse_timestamps(data)
+    return Conversation.model_construct(**data)
@@ -5,6 +5,10 @@ from typing import Dict, List
 import re
 from unidecode import unidecode
 
+# Patrones usados en cada normalización, compilados una sola vez
+_NON_ALNUM = re.compile(r'[^a-z0-9\s]')
+_AREA = re.compile(r'^([\d.]+)\s*([a-zA-Z]+)$')
+
 def normalize_text(text: str) -> str:
     """
     Normaliza el texto para hacerlo más fácil de comparar
@@ -23,7 +27,7 @@ def normalize_text(text: str) -> str:
     text = unidecode(text)
     
     # Eliminar caracteres especiales
-    text = re.sub(r'[^a-z0-9\s]', '', text)
+    text = _NON_ALNUM.sub('', text)
     
     return text
     
@@ -167,7 +171,7 @@ def normalize_text_new(text: str) -> str:
         text = text.replace(old, new)
     
     # Quitar caracteres especiales y espacios extra
-    text = re.sub(r'[^a-z0-9\s]', '', text)
+    text = _NON_ALNUM.sub('', text)
     text = ' '.join(text.split())
     
     return text
@@ -201,7 +205,7 @@ def parse_area(text: str) -> Optional[Tuple[float, str]]:
         text = text.replace(';', '.')
         
         # Extraer número y unidad
-        match = re.match(r'^([\d.]+)\s*([a-zA-Z]+)$', text)
+        match = _AREA.match(text)
         if not match:
             return None
             
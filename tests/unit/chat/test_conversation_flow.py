@@ -0,0 +1,26 @@
+"""
+Pruebas unitarias para el flujo de conversación
+"""
+import unittest
+
+from app.chat.conversation_flow import ConversationFlow
+
+class TestConversationFlow(unittest.TestCase):
+    """Pruebas para la validación de respuestas del usuario"""
+
+    def setUp(self):
+        """Configuración inicial para las pruebas"""
+        self.flow = ConversationFlow()
+
+    def test_validate_yes_no_answers(self):
+        """Prueba las respuestas de SI/NO con y sin tildes"""
+        for state in (self.flow.STATES['ASK_LOAN'], self.flow.STATES['SHOW_ANALYSIS']):
+            with self.subTest(state=state):
+                self.assertEqual(self.flow.validate_input(state, 'sí'), (True, True))
+                self.assertEqual(self.flow.validate_input(state, 'Si'), (True, True))
+                self.assertEqual(self.flow.validate_input(state, 'Está bien'), (True, True))
+                self.assertEqual(self.flow.validate_input(state, 'no'), (True, False))
+                self.assertEqual(self.flow.validate_input(state, 'tal vez'), (False, None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,298 @@
+"""
+Pruebas unitarias para el servicio de conversaciones
+"""
+import asyncio
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import AsyncMock
+
+from app.database.firebase import FirebaseDB
+from app.models.conversation import MAX_MESSAGES
+from app.services.conversation_service import ConversationService, _request_cache
+
+class TestConversationService(unittest.IsolatedAsyncioTestCase):
+    """Pruebas para el manejo de conversaciones"""
+
+    def setUp(self):
+        """Configuración inicial para las pruebas"""
+        self.service = ConversationService()
+        self.service.db = FirebaseDB()
+
+    async def test_get_active_conversation_uses_cache(self):
+        """Prueba que la conversación activa se sirve desde el caché"""
+        conversation = await self.service.create_conversation('user-1')
+
+        # Vaciar la base de datos: el caché debe seguir respondiendo
+        self.service.db.memory_db.clear()
+        active = await self.service.get_active_conversation('user-1')
+
+        self.assertIs(active, conversation)
+
+    async def test_get_active_conversation_populates_cache(self):
+        """Prueba que una lectura de la base de datos llena el caché"""
+        conversation = await self.service.create_conversation('user-1')
+        self.service._active_cache.clear()
+
+        active = await self.service.get_active_conversation('user-1')
+
+        self.assertEqual(active.id, conversation.id)
+        self.assertIn('user-1', self.service._active_cache)
+
+    async def test_get_active_conversation_reads_user_pointer(self):
+        """Prueba que la conversación activa se obtiene sin consultar la colección"""
+        conversation = await self.service.create_conversation('user-1')
+        self.service._active_cache.clear()
+        self.service.db.query_collection = AsyncMock()
+
+        active = await self.service.get_active_conversation('user-1')
+        user = await self.service.db.get_document('users', 'user-1')
+
+        self.assertEqual(active.id, conversation.id)
+        self.assertEqual(user['active_conversation'], conversation.id)
+        self.service.db.query_collection.assert_not_awaited()
+
+    async def test_get_active_conversation_with_known_id(self):
+        """Prueba que con el ID conocido se leen ambos documentos en un solo lote"""
+        first = await self.service.create_conversation('user-1')
+        second = await self.service.create_conversation('user-1')
+        self.service._active_cache.clear()
+        self.service.db.get_document = AsyncMock(wraps=self.service.db.get_document)
+
+        active = await self.service.get_active_conversation('user-1', second.id)
+        self.service._active_cache.clear()
+        stale = await self.service.get_active_conversation('user-1', first.id)
+
+        self.assertEqual(active.id, second.id)
+        self.assertEqual(stale.id, second.id)
+        # Solo la pista desactualizada necesita una lectura adicional
+        self.service.db.get_document.assert_awaited_once_with('conversations', second.id)
+
+    async def test_get_active_conversation_uses_cached_id(self):
+        """Prueba que el ID en caché permite leer usuario y conversación juntos"""
+        conversation = await self.service.create_conversation('user-1')
+        self.service._active_cache.clear()
+        self.service.db.get_document = AsyncMock(wraps=self.service.db.get_document)
+
+        active = await self.service.get_active_conversation('user-1')
+
+        self.assertEqual(active.id, conversation.id)
+        self.service.db.get_document.assert_not_awaited()
+
+    async def test_end_conversation_invalidates_cache(self):
+        """Prueba que terminar la conversación la saca del caché"""
+        conversation = await self.service.create_conversation('user-1')
+
+        await self.service.end_conversation(conversation.id)
+
+        self.assertNotIn('user-1', self.service._active_cache)
+        self.assertIsNone(await self.service.get_active_conversation('user-1'))
+
+    async def test_add_message_updates_cached_conversation(self):
+        """Prueba que agregar un mensaje actualiza la copia en caché"""
+        conversation = await self.service.create_conversation('user-1')
+
+        await self.service.add_message(conversation.id, 'user', 'hola')
+        active = await self.service.get_active_conversation('user-1')
+
+        self.assertEqual([m.content for m in active.messages], ['hola'])
+
+    async def test_add_message_does_not_read_conversation(self):
+        """Prueba que agregar un mensaje no lee la conversación de la base de datos"""
+        conversation = await self.service.create_conversation('user-1')
+        self.service._conversation_cache.clear()
+        self.service.db.get_document = AsyncMock(wraps=self.service.db.get_document)
+
+        await self.service.add_message(conversation.id, 'user', 'hola', user_id='user-1')
+        active = await self.service.get_active_conversation('user-1')
+
+        self.service.db.get_document.assert_not_awaited()
+        self.assertEqual([m.content for m in active.messages], ['hola'])
+
+    async def test_add_message_writes_to_subcollection(self):
+        """Prueba que los mensajes se guardan fuera del documento principal"""
+        conversation = await self.service.create_conversation('user-1')
+
+        await self.service.add_message(conversation.id, 'user', 'si')
+        await self.service.add_message(conversation.id, 'user', 'si')
+        stored = await self.service.db.get_document('conversations', conversation.id)
+        messages = await self.service.db.get_collection(f'conversations/{conversation.id}/messages')
+
+        self.assertEqual(stored['messages'], [])
+        self.assertEqual([m['content'] for m in messages], ['si', 'si'])
+
+    async def test_get_conversation_with_messages(self):
+        """Prueba que los mensajes de la subcolección se cargan solo cuando se piden"""
+        conversation = await self.service.create_conversation('user-1')
+        await self.service.add_message(conversation.id, 'user', 'hola')
+        self.service._conversation_cache.clear()
+
+        without = await self.service.get_conversation(conversation.id)
+        self.assertEqual(len(without.messages), 0)
+        loaded = await self.service.get_conversation(conversation.id, with_messages=True)
+
+        self.assertEqual([m.content for m in loaded.messages], ['hola'])
+
+    async def test_history_survives_cache_expiry_between_messages(self):
+        """Prueba que un mensaje agregado tras expirar el caché no oculta el historial"""
+        conversation = await self.service.create_conversation('user-1')
+        await self.service.add_message(conversation.id, 'user', 'a')
+        await self.service.add_message(conversation.id, 'user', 'b')
+        self.service._conversation_cache.clear()
+        self.service._active_cache.clear()
+
+        await self.service.add_message(conversation.id, 'user', 'c')
+        loaded = await self.service.get_conversation(conversation.id, with_messages=True)
+
+        self.assertEqual([m.content for m in loaded.messages], ['a', 'b', 'c'])
+
+    async def test_reset_model_reloads_history(self):
+        """Prueba que una conversación reiniciada en memoria vuelve a leer su historial"""
+        conversation = await self.service.create_conversation('user-1')
+        await self.service.add_message(conversation.id, 'user', 'hola')
+
+        conversation.reset()
+        self.assertFalse(conversation.history_loaded)
+        loaded = await self.service.get_conversation(conversation.id, with_messages=True)
+
+        self.assertIs(loaded, conversation)
+        self.assertEqual([m.content for m in loaded.messages], ['hola'])
+
+    async def test_get_recent_messages(self):
+        """Prueba que se obtienen solo los últimos mensajes en orden"""
+        conversation = await self.service.create_conversation('user-1')
+        for i in range(5):
+            await self.service.add_message(conversation.id, 'user', str(i))
+
+        recent = await self.service.get_recent_messages(conversation.id, n=3)
+
+        self.assertEqual([m.content for m in recent], ['2', '3', '4'])
+
+    async def test_reset_conversation(self):
+        """Prueba que reiniciar limpia el contexto y el caché"""
+        conversation = await self.service.create_conversation('user-1')
+        await self.service.update_context(conversation.id, {'retry_count': 2, 'collected_data': {'area': 2}})
+
+        await self.service.reset_conversation(conversation.id)
+        reset = await self.service.get_conversation(conversation.id)
+        stored = await self.service.db.get_document('conversations', conversation.id)
+
+        self.assertEqual(reset.context.state, 'initial')
+        self.assertEqual(reset.context.retry_count, 0)
+        self.assertEqual(reset.context.collected_data, {})
+        self.assertEqual(stored['context']['retry_count'], 0)
+        self.assertNotIn('user-1', self.service._active_cache)
+
+    async def test_update_context_writes_only_changed_fields(self):
+        """Prueba que actualizar el contexto conserva los demás campos guardados"""
+        conversation = await self.service.create_conversation('user-1')
+        await self.service.update_context(conversation.id, {'collected_data': {'area': 2}})
+
+        await self.service.update_context(conversation.id, {'state': 'asking_area'})
+        stored = await self.service.db.get_document('conversations', conversation.id)
+
+        self.assertEqual(stored['context']['state'], 'asking_area')
+        self.assertEqual(stored['context']['collected_data'], {'area': 2})
+        with self.assertRaises(ValueError):
+            await self.service.update_context(conversation.id, {'state': 'no-existe'})
+
+    async def test_update_context_keeps_active_conversation_cached(self):
+        """Prueba que actualizar el contexto no descarta la conversación activa"""
+        conversation = await self.service.create_conversation('user-1')
+        await self.service.add_message(conversation.id, 'user', 'hola')
+
+        await self.service.update_context(conversation.id, {'state': 'asking_area'})
+        active = self.service._active_cache['user-1']
+
+        self.assertEqual(active.context.state, 'asking_area')
+        self.assertEqual([m.content for m in active.messages], ['hola'])
+        with self.assertRaises(ValueError):
+            await self.service.update_context(conversation.id, {'no_existe': 1})
+
+    async def test_get_conversation_not_found(self):
+        """Prueba que una conversación inexistente genera error"""
+        with self.assertRaises(ValueError):
+            await self.service.get_conversation('no-existe')
+
+    async def test_get_conversation_parses_iso_timestamps(self):
+        """Prueba que las fechas guardadas como texto ISO se convierten a datetime"""
+        conversation = await self.service.create_conversation('user-1')
+        stored = await self.service.db.get_document('conversations', conversation.id)
+        stored['updated_at'] = '2024-05-01T10:00:00Z'
+        stored['messages'] = [{'role': 'user', 'content': 'hola', 'timestamp': '2024-05-01T09:59:00'}]
+        self.service._conversation_cache.clear()
+
+        loaded = await self.service.get_conversation(conversation.id)
+
+        self.assertEqual(loaded.updated_at, datetime(2024, 5, 1, 10, tzinfo=timezone.utc))
+        self.assertEqual(loaded.messages[0].timestamp, datetime(2024, 5, 1, 9, 59))
+
+    async def test_get_conversation_uses_short_cache(self):
+        """Prueba que las lecturas seguidas de una conversación no van a la base de datos"""
+        conversation = await self.service.create_conversation('user-1')
+        self.service.db.get_document = AsyncMock(wraps=self.service.db.get_document)
+
+        await self.service.get_conversation(conversation.id)
+        await self.service.update_context(conversation.id, {'retry_count': 1})
+        loaded = await self.service.get_conversation(conversation.id)
+
+        self.assertEqual(loaded.context.retry_count, 1)
+        self.service.db.get_document.assert_not_awaited()
+
+    async def test_get_conversation_memoized_per_request(self):
+        """Prueba que la conversación se reutiliza dentro de un mismo mensaje"""
+        conversation = await self.service.create_conversation('user-1')
+        token = _request_cache.set({})
+        try:
+            first = await self.service.get_conversation(conversation.id)
+            second = await self.service.get_conversation(conversation.id)
+            await self.service.update_context(conversation.id, {'retry_count': 1})
+            third = await self.service.get_conversation(conversation.id)
+        finally:
+            _request_cache.reset(token)
+
+        self.assertIs(first, second)
+        self.assertIsNot(first, third)
+        self.assertEqual(third.context.retry_count, 1)
+
+    async def test_create_conversation_ends_previous(self):
+        """Prueba que crear una conversación termina las anteriores"""
+        first = await self.service.create_conversation('user-1')
+        second = await self.service.create_conversation('user-1')
+        self.service._active_cache.clear()
+
+        active = await self.service.get_active_conversation('user-1')
+        stored = await self.service.db.get_document('conversations', first.id)
+
+        self.assertEqual(active.id, second.id)
+        self.assertFalse(stored['active'])
+
+    async def test_cached_messages_are_capped(self):
+        """Prueba que la conversación en caché conserva solo los mensajes recientes"""
+        conversation = await self.service.create_conversation('user-1')
+        for i in range(MAX_MESSAGES + 5):
+            await self.service.add_message(conversation.id, 'user', str(i))
+
+        active = await self.service.get_active_conversation('user-1')
+        stored = await self.service.db.get_collection(f'conversations/{conversation.id}/messages')
+
+        self.assertEqual(len(active.messages), MAX_MESSAGES)
+        self.assertEqual(active.messages[-1].content, str(MAX_MESSAGES + 4))
+        self.assertEqual(len(stored), MAX_MESSAGES + 5)
+
+    async def test_concurrent_messages_written_in_one_batch(self):
+        """Prueba que los mensajes concurrentes se escriben en un solo lote"""
+        conversation = await self.service.create_conversation('user-1')
+        batch_set = AsyncMock(wraps=self.service.db.batch_set)
+        self.service.db.batch_set = batch_set
+
+        await asyncio.gather(*(
+            self.service.add_message(conversation.id, 'user', str(i))
+            for i in range(5)
+        ))
+        recent = await self.service.get_recent_messages(conversation.id)
+
+        batch_set.assert_awaited_once()
+        self.assertEqual([m.content for m in recent], ['0', '1', '2', '3', '4'])
+
+if __name__ == '__main__':
+    unittest.main()
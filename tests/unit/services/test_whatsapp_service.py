@@ -0,0 +1,79 @@
+"""
+Pruebas unitarias para el servicio de WhatsApp
+"""
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import httpx
+import orjson
+
+from app.services import whatsapp_service as module
+from app.services.whatsapp_service import WhatsAppService, get_client, close_client
+
+class TestWhatsAppService(unittest.IsolatedAsyncioTestCase):
+    """Pruebas para el envío de mensajes"""
+
+    async def asyncSetUp(self):
+        """Usa un cliente compartido con transporte simulado"""
+        self.requests = []
+        self.statuses = []
+
+        def handler(request: httpx.Request) -> httpx.Response:
+            self.requests.append(request)
+            if self.statuses and self.statuses[0] == 'timeout':
+                raise httpx.ConnectTimeout('timeout', request=request)
+            if self.statuses:
+                return httpx.Response(self.statuses.pop(0), headers={'Retry-After': '1'})
+            return httpx.Response(200, json={'messages': [{'id': 'wamid.1'}]})
+
+        module._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        self.service = WhatsAppService()
+
+    async def asyncTearDown(self):
+        """Cierra el cliente compartido"""
+        await close_client()
+
+    async def test_sends_reuse_shared_client(self):
+        """Prueba que los envíos no cierran ni recrean el cliente compartido"""
+        client = await get_client()
+
+        await self.service.send_message('+502 5555-1234', 'hola')
+        await self.service.send_message('50255551234', 'adiós')
+
+        self.assertIs(await get_client(), client)
+        self.assertFalse(client.is_closed)
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(orjson.loads(self.requests[0].content)['to'], '50255551234')
+
+    async def test_rate_limited_send_is_retried(self):
+        """Prueba que un 429 se reintenta respetando Retry-After"""
+        self.statuses = [429]
+
+        with patch('app.services.whatsapp_service.asyncio.sleep', new=AsyncMock()) as sleep:
+            sent = await self.service.send_message('50255551234', 'hola')
+
+        self.assertTrue(sent)
+        self.assertEqual(len(self.requests), 2)
+        sleep.assert_awaited_once_with(1.0)
+
+    async def test_server_error_is_not_retried(self):
+        """Prueba que un 500 no se reenvía para no duplicar el mensaje"""
+        self.statuses = [500]
+
+        with self.assertRaises(httpx.HTTPStatusError):
+            await self.service.send_message('50255551234', 'hola')
+
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_timeout_is_logged_separately(self):
+        """Prueba que un timeout se registra con su tipo y se propaga"""
+        self.statuses = ['timeout']
+
+        with self.assertLogs('app.services.whatsapp_service', 'WARNING') as logs:
+            with self.assertRaises(httpx.ConnectTimeout):
+                await self.service.send_message('50255551234', 'hola')
+
+        self.assertIn('ConnectTimeout', logs.output[0])
+
+if __name__ == '__main__':
+    unittest.main()
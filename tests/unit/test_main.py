@@ -0,0 +1,91 @@
+"""
+Pruebas unitarias para el webhook de WhatsApp
+"""
+import logging
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import httpx
+import orjson
+
+from app import main
+
+def _webhook_body(*messages: dict) -> bytes:
+    """Arma el cuerpo de un webhook con los mensajes dados"""
+    return orjson.dumps({'entry': [{'changes': [{'value': {'messages': list(messages)}}]}]})
+
+def _text(message_id: str, sender: str, body: str) -> dict:
+    """Arma un mensaje de texto entrante"""
+    return {'id': message_id, 'from': sender, 'type': 'text', 'text': {'body': body}}
+
+class TestWebhook(unittest.IsolatedAsyncioTestCase):
+    """Pruebas para la recepción de mensajes"""
+
+    async def asyncSetUp(self):
+        """Cliente ASGI contra la app, sin verificar firma"""
+        main._seen_messages.clear()
+        patcher = patch.object(main.settings, 'DEBUG', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handle_message = AsyncMock()
+        patcher = patch.object(main.conversation_flow, 'handle_message', self.handle_message)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=main.app),
+            base_url='http://test'
+        )
+
+    async def asyncTearDown(self):
+        """Cierra el cliente"""
+        await self.client.aclose()
+
+    async def test_redelivered_message_is_processed_once(self):
+        """Prueba que un webhook reenviado con el mismo ID no se procesa dos veces"""
+        body = _webhook_body(_text('wamid.1', '502', 'hola'))
+
+        first = await self.client.post('/webhook/whatsapp', content=body)
+        second = await self.client.post('/webhook/whatsapp', content=body)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.handle_message.assert_awaited_once_with('502', 'hola')
+
+    async def test_webhook_acknowledges_and_keeps_sender_order(self):
+        """Prueba que el webhook responde 200 y procesa en orden los mensajes de cada remitente"""
+        statuses = orjson.dumps({'entry': [{'changes': [{'value': {'statuses': [{'id': 'wamid.0'}]}}]}]})
+        body = _webhook_body(
+            _text('wamid.1', '502', 'maiz'),
+            _text('wamid.2', '503', 'hola'),
+            _text('wamid.3', '502', '2')
+        )
+
+        ignored = await self.client.post('/webhook/whatsapp', content=statuses)
+        self.handle_message.assert_not_awaited()
+        response = await self.client.post('/webhook/whatsapp', content=body)
+
+        self.assertEqual(ignored.status_code, 200)
+        self.assertEqual(response.status_code, 200)
+        calls = [call.args for call in self.handle_message.await_args_list]
+        self.assertEqual([text for sender, text in calls if sender == '502'], ['maiz', '2'])
+        self.assertEqual([text for sender, text in calls if sender == '503'], ['hola'])
+
+class TestLogging(unittest.IsolatedAsyncioTestCase):
+    """Pruebas para la cola de logging"""
+
+    async def test_queue_listener_runs_only_while_app_is_up(self):
+        """Prueba que la cola se activa al arrancar y los handlers se restauran al detener"""
+        root = logging.getLogger()
+        handlers = list(root.handlers)
+        self.assertIsNone(main.log_listener)
+
+        await main.startup()
+        self.addAsyncCleanup(main.shutdown)
+        self.assertEqual(root.handlers, [main._queue_handler])
+        await main.shutdown()
+
+        self.assertEqual(root.handlers, handlers)
+        self.assertIsNone(main.log_listener)
+
+if __name__ == '__main__':
+    unittest.main()